@@ -0,0 +1,280 @@
+"""
+Benchmark of the extraction stages on a seeded synthetic corpus.
+
+usage:
+    python3 benchmark.py --docs 200 --seed 0 --output bench.json
+    python3 benchmark.py --docs 200 --compare bench.json   # 和上次的結果比較
+
+每個stage回報 docs/s, MB/s, items/s (rows, cells...) 和 peak memory(tracemalloc)。
+memo(see memo.py)只在 end_to_end_memo 開著，每次repeat前清空，其他stage不用memo，repeat之間不會變成量memo hit。
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import memo
+import tools
+
+
+SURNAMES = '王李張劉陳楊黃趙吳周徐孫馬朱胡郭何林高羅'
+GIVEN_NAMES = '小大明華美瑩志偉淑芬建國家豪俊傑宗翰雅婷怡君'
+CHARGES = ['詐欺取財罪', '行使偽造公文書罪', '竊盜罪', '幫助洗錢罪', '販賣第二級毒品罪', '偽造私文書罪', '侵占罪']
+NUMERALS = '壹貳參肆伍陸柒捌玖拾'
+FILLER = ('被告明知金融帳戶為個人信用之表徵，竟基於幫助詐欺取財之不確定故意，將其申設之帳戶存摺、提款卡及密碼'
+          '交付真實姓名年籍不詳之詐欺集團成員使用，嗣該集團成員以附表所示方式詐騙被害人，致其陷於錯誤而匯款。')
+
+
+def _name(rng):
+    return rng.choice(SURNAMES) + ''.join(rng.choice(GIVEN_NAMES) for _ in range(2))
+
+
+def _sentence(rng, name):
+    charge = rng.choice(CHARGES)
+    sentence = '{}犯{}，處有期徒刑{}年{}月'.format(name, charge, rng.choice(NUMERALS[:5]), rng.choice(NUMERALS))
+    roll = rng.random()
+    if roll < 0.2:
+        sentence += '，減為有期徒刑{}月'.format(rng.choice(NUMERALS))
+    elif roll < 0.35:
+        sentence += '，緩刑{}年'.format(rng.choice(NUMERALS[:5]))
+    elif roll < 0.45:
+        sentence += '，禠奪公權{}年'.format(rng.choice(NUMERALS[:5]))
+    elif roll < 0.5:
+        sentence = '{}被訴{}部分無罪'.format(name, charge)
+    return sentence + '。'
+
+
+def _wrap(text, width):
+    """cut full width text into lines of width chars, padded with full width space."""
+    lines = [text[i:i + width] for i in range(0, len(text), width)] or ['']
+    return [line + '　' * (width - len(line)) for line in lines]
+
+
+def render_table(rows, widths, nested=False, malformed=False):
+    """
+    draw a box table. widths: column widths in full width chars.
+    nested: 第一個row的最後一個cell內放一個小表格.
+    malformed: 拿掉右下角 '┘' 並讓一行多一個column.
+    """
+    def rule(left, middle, right):
+        return left + middle.join('─' * w for w in widths) + right
+
+    lines = [rule('┌', '┬', '┐')]
+    for r, row in enumerate(rows):
+        if r:
+            lines.append(rule('├', '┼', '┤'))
+        wrapped = [_wrap(cell, w) for cell, w in zip(row, widths)]
+        if nested and r == 0 and widths[-1] >= 4:
+            inner = widths[-1] - 2
+            wrapped[-1] += ['┌' + '─' * inner + '┐', '│' + _wrap('附件', inner)[0] + '│', '└' + '─' * inner + '┘']
+        height = max(len(cell) for cell in wrapped)
+        for i in range(height):
+            lines.append('│' + '│'.join(cell[i] if i < len(cell) else '　' * w
+                                        for cell, w in zip(wrapped, widths)) + '│')
+    if malformed:
+        lines.insert(2, lines[1] + '　│')
+    lines.append(rule('└', '┴', '┘' if not malformed else '┤'))
+    return '\n'.join(lines)
+
+
+def generate_judgment(rng, accused=2, tables=2, rows=6, nested=0.1, malformed=0.1, filler=20):
+    """
+    synthetic 判決書 with the headings, accused lines and 附表 that the extractors look for.
+    :param accused: number of 被告
+    :param tables: number of 附表
+    :param rows: rows per table
+    :param nested: probability of a table inside a table
+    :param malformed: probability of a malformed table
+    :param filler: paragraphs of 理由 text
+    :return: tuple(text, list of accused names)
+    """
+    names = []
+    while len(names) < accused:
+        name = _name(rng)
+        if name not in names:
+            names.append(name)
+
+    parts = ['臺灣臺北地方法院刑事判決', '{}年度訴字第{}號'.format(rng.randint(90, 112), rng.randint(1, 2000)),
+             '公　訴　人　臺灣臺北地方檢察署檢察官']
+    parts += ['被　　　告　{}　男　民國{}年生'.format(name, rng.randint(40, 90)) for name in names]
+    parts += ['上列被告因詐欺等案件，經檢察官提起公訴，本院判決如下：', '    主 文']
+    parts += ['{}犯如附表所示之罪，各處如附表所示之刑。'.format(name) for name in names]
+    parts += ['    犯罪事實及理由']
+    parts += ['{}、{}'.format(NUMERALS[i % 10], FILLER * rng.randint(1, 4)) for i in range(filler)]
+    parts += ['以上正本證明與原本無異。', '附錄本案論罪科刑法條全文']
+    for t in range(tables):
+        table_rows = [['編號', '犯罪事實', '主文']]
+        table_rows += [[NUMERALS[r % 10], FILLER[:rng.randint(10, 40)], _sentence(rng, rng.choice(names))]
+                       for r in range(rows)]
+        parts += ['附表{}：'.format(NUMERALS[t % 10]),
+                  render_table(table_rows, [2, rng.randint(8, 14), rng.randint(12, 20)],
+                               nested=rng.random() < nested, malformed=rng.random() < malformed)]
+    return '\n'.join(parts) + '\n', names
+
+
+def generate_corpus(docs=100, seed=0, **kwargs):
+    """:return: list of (name, text), deterministic for the same seed and arguments."""
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(docs):
+        text, _ = generate_judgment(rng, **kwargs)
+        corpus.append(('{:06d}.txt'.format(i), text))
+    return corpus
+
+
+def _stages():
+    """:return: list of (stage name, function(texts) -> (input bytes, items))."""
+    import extract_declared_sentence
+
+    def accused(texts):
+        return sum(len(text.encode('utf-8')) for text in texts), sum(len(list(tools.extract_accuseds(text)))
+                                                                     for text in texts)
+
+    def locate(texts):
+        return sum(len(text.encode('utf-8')) for text in texts), sum(len(tools.locate_tables(text)) for text in texts)
+
+    def rows(texts):
+        size = n = 0
+        for text in texts:
+            for start, end in tools.locate_tables(text):
+                size += len(text[start:end].encode('utf-8'))
+                try:
+                    n += len(list(tools.extract_rows(text, start, end)))
+                except tools.TableFormatException:
+                    pass
+        return size, n
+
+    def parse(texts):
+        size = n = 0
+        for text in texts:
+            for start, end in tools.locate_tables(text):
+                size += len(text[start:end].encode('utf-8'))
+                try:
+                    n += len(tools.parse_table(text, start, end).cells)
+                except tools.TableFormatException:
+                    pass
+        return size, n
+
+    def sentences(texts):
+        size = n = 0
+        for text in texts:
+            cells = tools.extract_cells(text)
+            size += sum(len(cell.encode('utf-8')) for cell in cells)
+            n += sum(len(pairs) for pairs in tools.extract_sentences_per_accused(
+                frozenset(tools.extract_accuseds(text)), cells).values())
+        return size, n
+
+    def end_to_end(texts):
+        return (sum(len(text.encode('utf-8')) for text in texts),
+                sum(1 for text in texts if extract_declared_sentence.process_text(text)[0] is not None))
+
+    return [('accused', accused), ('locate_tables', locate), ('extract_rows', rows),
+            ('parse', parse), ('sentences', sentences), ('end_to_end', end_to_end),
+            ('end_to_end_memo', end_to_end)]
+
+
+ITEM_NAMES = {'accused': 'accused', 'locate_tables': 'tables', 'extract_rows': 'rows',
+              'parse': 'cells', 'sentences': 'pairs', 'end_to_end': 'outputs', 'end_to_end_memo': 'outputs'}
+MEMO_STAGES = {'end_to_end_memo'}
+
+
+def _reset_memo(name):
+    """empty memo before each pass of stage name, disabled except for MEMO_STAGES."""
+    if name in MEMO_STAGES:
+        memo.configure()
+    else:
+        memo.configure(0, 0)
+
+
+def run(corpus, repeat=3, memory=True, stages=None):
+    """
+    :return: dict of stage name -> {'seconds', 'docs/s', 'MB/s', '<items>/s', 'items', 'memo', 'peak_memory'}.
+        seconds is the best of repeat runs, memo is memo.stats() of the last one. memo的內容和設定跑完後還原。
+    """
+    texts = [text for _, text in corpus]
+    results = {}
+    saved = memo.tables, memo.matches
+    try:
+        for name, stage in _stages():
+            if stages and name not in stages:
+                continue
+            best = None
+            for _ in range(repeat):
+                _reset_memo(name)
+                start = time.perf_counter()
+                size, items = stage(texts)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+
+            result = {'seconds': best,
+                      'docs/s': len(texts) / best,
+                      'MB/s': size / 1e6 / best,
+                      'items': items,
+                      '{}/s'.format(ITEM_NAMES[name]): items / best,
+                      'memo': memo.stats()}
+            if memory:
+                _reset_memo(name)
+                tracemalloc.start()
+                stage(texts)
+                result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            results[name] = result
+    finally:
+        memo.tables, memo.matches = saved
+    return results
+
+
+def compare(results, baseline):
+    """print speedup of each stage against a previous run."""
+    for name, result in results.items():
+        if name in baseline:
+            print('{:<14} {:>8.3f}s  {:>6.2f}x'.format(name, result['seconds'],
+                                                      baseline[name]['seconds'] / result['seconds']))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark extraction stages on a synthetic corpus')
+    parser.add_argument('--docs', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--accused', type=int, default=2, help='被告 per doc')
+    parser.add_argument('--tables', type=int, default=2, help='附表 per doc')
+    parser.add_argument('--rows', type=int, default=6, help='rows per table')
+    parser.add_argument('--nested', type=float, default=0.1, help='probability of a nested table')
+    parser.add_argument('--malformed', type=float, default=0.1, help='probability of a malformed table')
+    parser.add_argument('--filler', type=int, default=20, help='理由 paragraphs per doc')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stages', type=lambda value: value.split(','), help='comma separated stage names')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass')
+    parser.add_argument('--output', help='save results as json')
+    parser.add_argument('--compare', help='json results of a previous run')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    params = {'docs': args.docs, 'seed': args.seed, 'accused': args.accused, 'tables': args.tables,
+              'rows': args.rows, 'nested': args.nested, 'malformed': args.malformed, 'filler': args.filler}
+    corpus = generate_corpus(**params)
+    results = run(corpus, args.repeat, not args.no_memory, args.stages)
+    report = {'params': params,
+              'corpus_bytes': sum(len(text.encode('utf-8')) for _, text in corpus),
+              'python': platform.python_version(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'stages': results}
+
+    json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+    print()
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(results, json.load(f)['stages'])
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+SQLite result cache keyed by content hash + extractor version.
+
+同內容的doc不用重新抽取。cache內存的是pickle過的抽取結果，
+拿出來和重新算的結果一模一樣。超過max_bytes時刪掉最久沒用到的。
+"""
+import hashlib
+import logging
+import pickle
+import sqlite3
+import time
+
+import tools
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PATH = 'extract_cache.sqlite'
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+_caches = {}  # per process, path -> ResultCache
+
+
+def content_hash(text):
+    return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).hexdigest()
+
+
+def open_cache(path=DEFAULT_PATH, max_bytes=DEFAULT_MAX_BYTES):
+    """one ResultCache per path per process, so pool workers can each open their own connection."""
+    if path not in _caches:
+        _caches[path] = ResultCache(path, max_bytes)
+    return _caches[path]
+
+
+class ResultCache(object):
+    """
+    key: namespace(抽取的種類和使用的函數) + tools.EXTRACTOR_VERSION + content hash.
+    value: pickled result.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, max_bytes=DEFAULT_MAX_BYTES, version=tools.EXTRACTOR_VERSION):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+
+        # WAL讓多個worker process可以同時讀寫
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS cache ('
+                        'key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+
+    def key(self, namespace, text):
+        return '{}:{}:{}'.format(namespace, self.version, content_hash(text))
+
+    def get(self, namespace, text):
+        """:return: cached value or None"""
+        key = self.key(namespace, text)
+        row = self.db.execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.db.execute('UPDATE cache SET accessed = ? WHERE key = ?', (time.time(), key))
+        return pickle.loads(row[0])
+
+    def put(self, namespace, text, value):
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self.db.execute('INSERT OR REPLACE INTO cache (key, value, size, accessed) VALUES (?, ?, ?, ?)',
+                        (self.key(namespace, text), blob, len(blob), time.time()))
+        self.total_bytes += len(blob)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """刪掉最久沒用到的entries，直到低於max_bytes的90%."""
+        # 其他process也會寫入，重新算一次總量
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+        excess = self.total_bytes - int(self.max_bytes * 0.9)
+        if excess <= 0:
+            return
+
+        keys = []
+        freed = 0
+        for key, size in self.db.execute('SELECT key, size FROM cache ORDER BY accessed'):
+            if freed >= excess:
+                break
+            keys.append(key)
+            freed += size
+
+        self.db.execute('BEGIN')
+        self.db.executemany('DELETE FROM cache WHERE key = ?', ((key,) for key in keys))
+        self.db.execute('COMMIT')
+        self.total_bytes -= freed
+        log.info('cache evicted {} entries, {} bytes'.format(len(keys), freed))
+
+    def close(self):
+        self.db.close()
+        if _caches.get(self.path) is self:
+            del _caches[self.path]
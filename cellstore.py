@@ -0,0 +1,238 @@
+"""
+Append-only columnar store of table cells, 取代 cells_per_doc.pickle.
+
+一個store是一個目錄：
+    cells.txt   所有cell字串串接的UTF-8 blob
+    cells.idx   每個cell在blob內的結束byte offset
+    tables.idx  每個table結束時累計的cell數
+    docs.idx    每個doc結束時累計的table數
+    names.txt, names.idx  doc名稱，同cells
+*.idx 都是native byte order的uint64 array，開頭隱含0。
+讀取用mmap，不需要載入整個store就能拿任一doc的cells。
+
+usage:
+    python3 cellstore.py convert cells_per_doc.pickle cells_per_doc
+"""
+import argparse
+import array
+import mmap
+import os
+import pickle
+
+
+CELLS = 'cells.txt'
+CELL_INDEX = 'cells.idx'
+TABLE_INDEX = 'tables.idx'
+DOC_INDEX = 'docs.idx'
+NAMES = 'names.txt'
+NAME_INDEX = 'names.idx'
+
+_INDEX_TYPE = 'Q'
+
+
+def _last(path):
+    """last value of an index file, 0 if empty."""
+    size = os.path.getsize(path)
+    if size == 0:
+        return 0
+    with open(path, 'rb') as f:
+        f.seek(size - array.array(_INDEX_TYPE).itemsize)
+        return array.array(_INDEX_TYPE, f.read()).pop()
+
+
+class CellStoreWriter(object):
+    """
+    streaming writer. append=True時已存在的store會接著寫，否則清空重寫.
+
+    with CellStoreWriter('cells_per_doc') as writer:
+        writer.add_document(name, cells_per_table)
+    """
+
+    def __init__(self, path, append=True):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.files = {}
+        for fn in (CELLS, CELL_INDEX, TABLE_INDEX, DOC_INDEX, NAMES, NAME_INDEX):
+            self.files[fn] = open(os.path.join(path, fn), 'ab' if append else 'wb')
+
+        # docs.idx最後寫，中斷時以docs.idx為準，截掉寫了一半的doc
+        n_tables = _last(os.path.join(path, DOC_INDEX))
+        n_docs = os.path.getsize(os.path.join(path, DOC_INDEX)) // array.array(_INDEX_TYPE).itemsize
+        n_cells = self._truncate(TABLE_INDEX, n_tables)
+        cell_bytes = self._truncate(CELL_INDEX, n_cells)
+        self._truncate_blob(CELLS, cell_bytes)
+        name_bytes = self._truncate(NAME_INDEX, n_docs)
+        self._truncate_blob(NAMES, name_bytes)
+
+        self.cell_bytes = cell_bytes
+        self.name_bytes = name_bytes
+        self.n_cells = n_cells
+        self.n_tables = n_tables
+
+    def _truncate(self, fn, length):
+        """truncate index file to length entries. :return: its last value"""
+        f = self.files[fn]
+        f.flush()
+        f.truncate(length * array.array(_INDEX_TYPE).itemsize)
+        return _last(os.path.join(self.path, fn))
+
+    def _truncate_blob(self, fn, size):
+        f = self.files[fn]
+        f.flush()
+        f.truncate(size)
+
+    def add_document(self, name, cells_per_table):
+        """:param cells_per_table: list of table which is a list of cell strings"""
+        cell_ends = array.array(_INDEX_TYPE)
+        table_ends = array.array(_INDEX_TYPE)
+        blob = []
+        for cells in cells_per_table:
+            for cell in cells:
+                data = cell.encode('utf-8', 'surrogatepass')
+                blob.append(data)
+                self.cell_bytes += len(data)
+                cell_ends.append(self.cell_bytes)
+            self.n_cells += len(cells)
+            table_ends.append(self.n_cells)
+        self.n_tables += len(table_ends)
+
+        name = name.encode('utf-8', 'surrogatepass')
+        self.name_bytes += len(name)
+
+        self.files[CELLS].write(b''.join(blob))
+        cell_ends.tofile(self.files[CELL_INDEX])
+        table_ends.tofile(self.files[TABLE_INDEX])
+        self.files[NAMES].write(name)
+        array.array(_INDEX_TYPE, [self.name_bytes]).tofile(self.files[NAME_INDEX])
+        array.array(_INDEX_TYPE, [self.n_tables]).tofile(self.files[DOC_INDEX])
+
+    def close(self):
+        for fn in (CELLS, CELL_INDEX, TABLE_INDEX, NAMES, NAME_INDEX, DOC_INDEX):
+            self.files[fn].close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _Mapped(object):
+    """read only mmap of a file; empty file is an empty buffer."""
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        if os.fstat(self.file.fileno()).st_size:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.mmap)
+        else:
+            self.mmap = None
+            self.view = memoryview(b'')
+
+    def index(self):
+        return self.view.cast(_INDEX_TYPE)
+
+    def close(self):
+        self.view.release()
+        if self.mmap is not None:
+            self.mmap.close()
+        self.file.close()
+
+
+class CellStore(object):
+    """
+    mmap reader.
+    store[i] -> cells of doc i (flat list, same as an item of cells_per_doc.pickle)
+    store.tables(i) -> list of table which is a list of cells
+    store.name(i), store.index(name)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._mapped = [_Mapped(os.path.join(path, fn))
+                        for fn in (CELLS, CELL_INDEX, TABLE_INDEX, DOC_INDEX, NAMES, NAME_INDEX)]
+        cells, cell_index, table_index, doc_index, names, name_index = self._mapped
+        self._cells = cells.view
+        self._cell_ends = cell_index.index()
+        self._table_ends = table_index.index()
+        self._doc_ends = doc_index.index()
+        self._names = names.view
+        self._name_ends = name_index.index()
+        self._name_to_index = None
+
+    def __len__(self):
+        return len(self._doc_ends)
+
+    @staticmethod
+    def _range(ends, i):
+        return (ends[i - 1] if i else 0), ends[i]
+
+    def _cell(self, i):
+        start, end = self._range(self._cell_ends, i)
+        return str(self._cells[start:end], 'utf-8', 'surrogatepass')
+
+    def name(self, i):
+        start, end = self._range(self._name_ends, i)
+        return str(self._names[start:end], 'utf-8', 'surrogatepass')
+
+    def names(self):
+        return [self.name(i) for i in range(len(self))]
+
+    def index(self, name):
+        """doc index of name (first one if duplicated)."""
+        if self._name_to_index is None:
+            self._name_to_index = {}
+            for i in reversed(range(len(self))):
+                self._name_to_index[self.name(i)] = i
+        return self._name_to_index[name]
+
+    def tables(self, i):
+        if i < 0:
+            i += len(self)
+        first_table, end_table = self._range(self._doc_ends, i)
+        tables = []
+        for t in range(first_table, end_table):
+            first_cell, end_cell = self._range(self._table_ends, t)
+            tables.append([self._cell(c) for c in range(first_cell, end_cell)])
+        return tables
+
+    def __getitem__(self, i):
+        return [cell for cells in self.tables(i) for cell in cells]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def close(self):
+        self._cells = self._cell_ends = self._table_ends = self._doc_ends = None
+        self._names = self._name_ends = None
+        for mapped in self._mapped:
+            mapped.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def convert_pickle(pickle_path, store_path):
+    """convert cells_per_doc.pickle to a store. 舊格式沒有table和doc名稱：每個doc一個table，名稱為index。"""
+    with open(pickle_path, 'rb') as f:
+        cells_per_doc = pickle.load(f)
+
+    with CellStoreWriter(store_path) as writer:
+        for i, cells in enumerate(cells_per_doc):
+            writer.add_document(str(i), [cells])
+    return len(cells_per_doc)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='cell store tools')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert = subparsers.add_parser('convert', help='convert cells_per_doc.pickle to a cell store')
+    convert.add_argument('pickle_path')
+    convert.add_argument('store_path')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        print('{} docs converted.'.format(convert_pickle(args.pickle_path, args.store_path)))
@@ -1,33 +1,105 @@
+import argparse
 import os
 import sys
 import pickle
 
+import cache
+import cellstore
+import extract_declared_sentence
+import sources
 import tools
 
 
-def main():
-    DIR = sys.argv[1]
-    if os.path.isdir(DIR):
-        dn, _, fns = next(os.walk(DIR))
-        paths = (os.path.join(dn, fn) for fn in fns if not fn.startswith('.'))
-    elif os.path.isfile(DIR):
-        paths = [DIR]
-    else:
+def iter_documents(path=None, cache_path=None, sections=None, include=None, exclude=None, recursive=True,
+                   prefetch=64, shard=None):
+    """cache_path: sqlite cache檔，沒改過的doc直接用cache結果(see cache.py)。
+    sections: 只抓這些section內的表格(see tools.SECTIONS)，None為全文。
+    path可以是檔案、目錄或zip/tar壓縮檔，include, exclude, recursive, shard see sources.iter_texts；
+    prefetch: 背景thread預先讀取的doc數，0為不用thread。
+    :return: iterable of (name, cells per table), None if path is neither a file nor a dir.
+    """
+    DIR = path if path is not None else sys.argv[1]
+    documents = sources.iter_texts(DIR, include, exclude, recursive, shard=shard)
+    if documents is None:
+        return None
+    if prefetch:
+        documents = sources.prefetch(documents, prefetch)
+
+    return _iter_documents(documents, cache_path, sections)
+
+
+def _iter_documents(documents, cache_path, sections):
+    result_cache = cache.open_cache(cache_path) if cache_path is not None else None
+    namespace = 'tables' if sections is None else 'tables:' + ','.join(sections)
+
+    for name, text in documents:
+        cells_per_table = result_cache.get(namespace, text) if result_cache is not None else None
+        if cells_per_table is None:
+            cells_per_table = list(tools.extract_cells_per_table(text, sections))
+            if result_cache is not None:
+                result_cache.put(namespace, text, cells_per_table)
+        yield name, cells_per_table
+
+
+def main(path=None, cache_path=None, sections=None, **kwargs):
+    """kwargs: include, exclude, recursive, prefetch, shard, see iter_documents.
+    :return: list of cells per doc (無法解析的table自動跳過), 同 cells_per_doc.pickle.
+    """
+    documents = iter_documents(path, cache_path, sections, **kwargs)
+    if documents is None:
         print('only accept a file or a dir path')
         return
 
-    cells_per_doc = []
-    for path in paths:
-        with open(path) as f:
-            text = f.read()
+    return [[cell for cells in cells_per_table for cell in cells] for _, cells_per_table in documents]
+
+
+def write_store(store_path, path=None, cache_path=None, sections=None, append=False, **kwargs):
+    """streaming寫入cell store(see cellstore.py)，記憶體用量和doc數無關。
+    append=False時覆蓋已存在的store。kwargs see iter_documents.
+    :return: number of docs written
+    """
+    documents = iter_documents(path, cache_path, sections, **kwargs)
+    if documents is None:
+        print('only accept a file or a dir path')
+        return 0
+
+    n = 0
+    with cellstore.CellStoreWriter(store_path, append) as writer:
+        for name, cells_per_table in documents:
+            writer.add_document(name, cells_per_table)
+            n += 1
+    return n
 
-            cells_per_doc.append(list(tools.extract_cells(text)))
 
-    return cells_per_doc
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='抽取表格cells')
+    parser.add_argument('path', help='file, directory or zip/tar(.gz/.xz) archive')
+    parser.add_argument('--include', action='append', help='only names matching this glob, e.g. "*.txt"; repeatable')
+    parser.add_argument('--exclude', action='append', help='skip names matching this glob; repeatable')
+    parser.add_argument('--no-recursive', action='store_true', help='only files at top level of the directory')
+    parser.add_argument('--shard', type=sources.parse_shard,
+                        help='i/N: only documents whose name hashes to shard i of N')
+    parser.add_argument('--prefetch', type=int, default=64,
+                        help='documents read ahead in a background thread, 0 to read in the main thread')
+    parser.add_argument('--sections', type=extract_declared_sentence.parse_sections,
+                        help='only extract tables in these comma separated sections: ' + ','.join(tools.SECTIONS))
+    parser.add_argument('--cache', default=cache.DEFAULT_PATH, help='result cache file')
+    parser.add_argument('--no-cache', action='store_true', help='re-extract every document')
+    parser.add_argument('--format', choices=['store', 'pickle'], default='store',
+                        help='store: cells_per_doc/ cell store (default); pickle: cells_per_doc.pickle for Python2')
+    parser.add_argument('--append', action='store_true', help='append to the existing cell store')
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
-    res = main()
+    args = parse_args()
+    cache_path = None if args.no_cache else args.cache
     here = os.path.dirname(os.path.abspath(__file__))
-    with open(os.path.join(here, "cells_per_doc.pickle"), "wb") as f:
-        pickle.dump(res, f, 2)
\ No newline at end of file
+    kwargs = {'include': args.include, 'exclude': args.exclude, 'recursive': not args.no_recursive,
+              'prefetch': args.prefetch, 'shard': args.shard}
+    if args.format == 'store':
+        write_store(os.path.join(here, "cells_per_doc"), args.path, cache_path, args.sections, args.append, **kwargs)
+    else:
+        res = main(args.path, cache_path, args.sections, **kwargs)
+        with open(os.path.join(here, "cells_per_doc.pickle"), "wb") as f:
+            pickle.dump(res, f, 2)
@@ -1,98 +1,509 @@
 import logging
 import logging.config
+import argparse
+import functools
 import itertools
+import multiprocessing
 import os
 import pprint
 import json
 import sys
+import time
+import traceback
 
+import cache
+import memo
+import metrics
+import penalty
+import resultstore
+import sources
 import tools
+import watch
 
 
-logging.basicConfig(filename='extract_declared_sentence.log', filemode='w', level=logging.INFO)
 log = logging.getLogger(__name__)
 
-count = {'doc': 0,  # #docs processed
-         'accused_extraction_fail': 0,
-         'table': 0,  # #tables processed
-         'table_format_exception': 0,
-         'table_processing_fail': 0,  # include format exception count
-         'output': 0  # #docs that has had result written out.
-}
+COUNTERS = ('doc',  # #docs processed
+            'accused_extraction_fail',
+            'table',  # #tables processed
+            'table_format_exception',
+            'table_processing_fail',  # include format exception count
+            'output',  # #docs that has had result written out.
+            'budget_exceeded',  # #docs aborted by --doc-budget
+            'cell_budget_exceeded',  # #cells skipped by --cell-budget
+            'prefilter_skipped_doc',  # #docs without 表格/主文/罪, not counted in other counters
+            'prefilter_skipped_cell',  # #cells without 罪 or any accused name
+            'read_bytes',
+            'decode_fail')  # #docs decoded with replacement characters
 
+# 整個process的統計，main()會把每份doc的結果merge進來。enabled=True才記各stage時間。
+run_metrics = metrics.Metrics(COUNTERS, enabled=False)
+count = run_metrics.counters
+# 讀檔的bytes, 秒數和編碼，main()讀完後merge進來。
+read_stats = sources.ReadStats()
+# memo.py的hit/miss，和process狀態有關，不算在count內。
+memo_count = dict.fromkeys(memo.stats(), 0)
 
-def main(extract_accuseds=tools.extract_accuseds,
-         extract_sentences=tools.extract_sentences):
+
+FAILURE_MESSAGES = {'accused': '\n{0}被告抽取失敗。',
+                    'table_format': '\n表格parsing失敗;{0} has table format not expected.',
+                    'table': '\n{0}表格內宣告刑抽取失敗',
+                    'budget': '\n{0}超過處理時間上限，放棄。',
+                    'decode': '\n{0}無法判斷編碼，無法解碼的字元以U+FFFD取代。'}
+
+
+def process_text(text,
+                 extract_accuseds=tools.extract_accuseds,
+                 extract_sentences=tools.extract_sentences,
+                 sections=None, timings=None, doc_budget=None, cell_budget=None, prefilter=True):
+    """抽取一份判決的宣告刑。不碰global count也不寫log，結果只和text有關(可以cache)，
+    text先經過tools.normalize_document，cell經過tools.normalize_cell。
+    除非超過doc_budget(doc_count['budget_exceeded']為1，不要cache)。
+    sections: 只抓這些section內的表格(see tools.SECTIONS)，None為全文。
+    timings: dict, 有給的話累加各stage的秒數(see metrics.STAGES)。
+    doc_budget: 每份doc的秒數上限；cell_budget: 超過這個字數的cell不抽取 (see tools.Budget)。
+    prefilter: 先用substring檢查跳過不可能有結果的doc和cell (see tools.prefilter_document)，
+        custom functions時doc只檢查有沒有表格，cell不檢查。
+    :return: tuple(charge_sentence_pairs or None, count of this doc,
+                   list of (log level, FAILURE_MESSAGES key, traceback))
     """
-    output [file name,{accused:[(charge,sentences),...],...}],... as json.
-    you can provide custom functions to keyword args extract_accuseds(text) and extract_accuseds(name,text)."""
-    DIR = sys.argv[1]
-    if os.path.isdir(DIR):
-        dn, _, fns = next(os.walk(DIR))
-        paths = (os.path.join(dn, fn) for fn in fns if not fn.startswith('.'))
-    elif os.path.isfile(DIR):
-        paths = [DIR]
-    else:
-        print('only accept a file or a dir path')
-        return
-
-
-    for path in paths:
-        count['doc'] += 1
-        with open(path) as f:
-            text = f.read()
-
-            # #被告抽取
-            try:
-                accused_list = frozenset(extract_accuseds(text))
-                if not accused_list:
-                    raise Exception('PatternNotFound: the return of accused name is None.')
-
-            except Exception as e:
-                log.exception('\n{}被告抽取失敗。'.format(f.name))
-                count['accused_extraction_fail'] += 1
-                continue
-
-            # #附表罪名和宣告刑抽取
-            try:
-                # 不做主文附表名稱抽取，直接table全抓。
-                # 假設附表一定是表格
-                cells_per_table = list(tools.extract_cells_per_table(text))
-
-                #count
-                failed_count = sum(1 for cells in cells_per_table if not cells)
-                if failed_count:
-                    log.info('\n表格parsing失敗;{0} has table format not expected.'.format(f.name))
-                    count['table_format_exception'] += failed_count
-                    count['table_processing_fail'] += failed_count
-                count['table'] += len(cells_per_table)
-
-                # 每個人的charge
-                # 假設罪名和宣告刑會放在同一cell，
+    doc_count = dict.fromkeys(COUNTERS, 0)
+    failures = []
+    stopwatch = metrics.Stopwatch(timings)
+    budget = tools.Budget(doc_budget, cell_budget).start()
+
+    doc_count['doc'] += 1
+    default_functions = extract_accuseds is tools.extract_accuseds and extract_sentences is tools.extract_sentences
+    if prefilter and not tools.prefilter_document(text, tools.PREFILTER_KEYWORDS if default_functions else ('┌',)):
+        doc_count['prefilter_skipped_doc'] += 1
+        return None, doc_count, failures
+
+    with stopwatch('normalize'):
+        text = tools.normalize_document(text)  # 長度不變，位置同原文
+    with stopwatch('accused'):
+        headings = tools.locate_sections(text)  # 各抽取共用
+
+    # #被告抽取
+    try:
+        with stopwatch('accused'):
+            if extract_accuseds is tools.extract_accuseds:
+                accused_list = tuple(dict.fromkeys(tools.extract_accuseds(text, headings)))  # 去重複，保留順序
+            else:
+                accused_list = tuple(dict.fromkeys(extract_accuseds(text)))
+        if not accused_list:
+            raise Exception('PatternNotFound: the return of accused name is None.')
+
+    except Exception as e:
+        failures.append((logging.ERROR, 'accused', traceback.format_exc()))
+        doc_count['accused_extraction_fail'] += 1
+        return None, doc_count, failures
+
+    # #附表罪名和宣告刑抽取
+    try:
+        # 不做主文附表名稱抽取，直接table全抓。
+        # 假設附表一定是表格
+        cells_per_table = extract_cells_per_table(text, sections, headings, stopwatch, budget)
+
+        #count
+        failed_count = sum(1 for cells in cells_per_table if not cells)
+        if failed_count:
+            failures.append((logging.INFO, 'table_format', ''))
+            doc_count['table_format_exception'] += failed_count
+            doc_count['table_processing_fail'] += failed_count
+        doc_count['table'] += len(cells_per_table)
+
+        # 每個人的charge
+        # 假設罪名和宣告刑會放在同一cell，
+        cells = itertools.chain.from_iterable(cells_per_table)
+        with stopwatch('sentences'):
+            if extract_sentences is tools.extract_sentences:
+                cells = [tools.normalize_cell(cell) for cell in cells]  # 每個cell只做一次
+                if prefilter and default_functions:
+                    kept = tools.prefilter_cells(accused_list, cells, normalized=True)
+                    doc_count['prefilter_skipped_cell'] += len(cells) - len(kept)
+                    cells = kept
+                charge_sentence_pairs = tools.extract_sentences_per_accused(accused_list, cells, budget,
+                                                                            normalized=True)
+            else:
+                cells = [cell for cell in cells if budget.allows(cell)]
                 charge_sentence_pairs = {}
                 for accused in accused_list:
                     charge_sentence_pairs[accused] = []
-                    for cell in itertools.chain.from_iterable(cells_per_table):
+                    for cell in cells:
+                        budget.check()
                         charge_sentence_pairs[accused] += list(extract_sentences(accused, cell))
+        doc_count['cell_budget_exceeded'] += budget.skipped_cells
 
-            except Exception as e:
-                log.exception('\n{}表格內宣告刑抽取失敗'.format(f.name))
-                count['table_processing_fail'] += 1
-                continue
-            else:
-                if any(charge_sentence_pairs.values()):  # 有東西才輸出
-                    filename = os.path.basename(f.name)
-                    count['output'] += 1
-                    yield [filename, charge_sentence_pairs]
+    except tools.BudgetExceededException:
+        failures.append((logging.WARNING, 'budget', traceback.format_exc()))
+        doc_count['budget_exceeded'] += 1
+        doc_count['cell_budget_exceeded'] += budget.skipped_cells
+        return None, doc_count, failures
+    except Exception as e:
+        failures.append((logging.ERROR, 'table', traceback.format_exc()))
+        doc_count['table_processing_fail'] += 1
+        return None, doc_count, failures
+    else:
+        if any(charge_sentence_pairs.values()):  # 有東西才輸出
+            doc_count['output'] += 1
+            return charge_sentence_pairs, doc_count, failures
+        else:
+            return None, doc_count, failures
+
+
+def extract_cells_per_table(text, sections=None, headings=None, stopwatch=metrics.Stopwatch(None), budget=None):
+    """同 tools.extract_cells_per_table，分開記 locate_tables, extract_rows, parse 的時間。
+    budget: tools.Budget，每個table之前檢查時間。
+    :rtype : list[list[str]]
+    """
+    with stopwatch('locate_tables'):
+        tables = tools.locate_tables_in_sections(text, sections, headings)
+
+    def parse(text, start, end):
+        try:
+            with stopwatch('extract_rows'):
+                rows = list(tools.extract_rows(text, start, end))
+            with stopwatch('parse'):
+                cells = []
+                for row in rows:
+                    cells += tools.parse_row(row)
+            return cells
+        except Exception as e:  #mainly TableFormatException
+            log.debug('{}'.format(e))
+            return []
+
+    cells_per_table = []
+    for start, end in tables:
+        if budget is not None:
+            budget.check()
+        cells_per_table.append(memo.table_cells(text, start, end, parse))
+    return cells_per_table
+
+
+def process_document(path,
+                     extract_accuseds=tools.extract_accuseds,
+                     extract_sentences=tools.extract_sentences,
+                     cache_path=None, sections=None, timed=False, doc_budget=None, cell_budget=None,
+                     prefilter=True):
+    """讀檔並抽取，可以在worker process跑。cache_path不是None時使用 cache.ResultCache。
+    path: file path, or tuple(name, text) from sources.iter_texts.
+    timed: 記錄各stage的秒數。doc_budget, cell_budget, prefilter see process_text，超過時間的結果不cache。
+    :return: tuple(file name, result or None, count of this doc,
+                   list of (log level, file name, log message), stage timings or None)
+    """
+    timings = {} if timed else None
+    stopwatch = metrics.Stopwatch(timings)
+    start = time.perf_counter()
+    memo_before = memo.stats()
+
+    if isinstance(path, tuple):
+        filename, text = path
+        path = filename
+    else:
+        filename = os.path.basename(path)
+        with stopwatch('read'):
+            text = sources.read_text(path)
+
+    if cache_path is None:
+        processed = process_text(text, extract_accuseds, extract_sentences, sections, timings,
+                                 doc_budget, cell_budget, prefilter)
+    else:
+        result_cache = cache.open_cache(cache_path)
+        namespace = 'sentence:{}.{}:{}.{}'.format(extract_accuseds.__module__, extract_accuseds.__qualname__,
+                                                   extract_sentences.__module__, extract_sentences.__qualname__)
+        if sections is not None:
+            namespace += ':' + ','.join(sections)
+        if cell_budget is not None:
+            namespace += ':cell_budget={}'.format(cell_budget)
+        if not prefilter:
+            namespace += ':no_prefilter'
+        processed = result_cache.get(namespace, text)
+        if processed is None:
+            processed = process_text(text, extract_accuseds, extract_sentences, sections, timings,
+                                     doc_budget, cell_budget, prefilter)
+            if not processed[1]['budget_exceeded']:
+                result_cache.put(namespace, text, processed)
+
+    charge_sentence_pairs, doc_count, failures = processed
+    doc_count = dict(doc_count)
+    for key, n in memo.stats().items():  # 不存在cache內，cache hit的doc不會重複計。_collect移到memo_count
+        doc_count[key] = n - memo_before[key]
+    failures = [(level, filename, FAILURE_MESSAGES[kind].format(path) + ('\n' + tb.rstrip('\n') if tb else ''))
+                for level, kind, tb in failures]
+    result = [filename, charge_sentence_pairs] if charge_sentence_pairs is not None else None
+    if timed:
+        timings['document'] = time.perf_counter() - start
+    return filename, result, doc_count, failures, timings
+
+
+def main(extract_accuseds=tools.extract_accuseds,
+         extract_sentences=tools.extract_sentences,
+         path=None, workers=1, chunksize=1, ordered=True, on_failure=None,
+         cache_path=None, sections=None, doc_budget=None, cell_budget=None, prefilter=True,
+         include=None, exclude=None, recursive=True, prefetch=64, memo_sizes=None, memo_shared=False,
+         shard=None, positions=None, documents=None, stats=None):
+    """
+    output [file name,{accused:[(charge,sentences),...],...}],... as json.
+    you can provide custom functions to keyword args extract_accuseds(text) and extract_sentences(name,text).
+    workers > 1 時用process pool平行處理，custom functions必須是module level(可pickle)。
+    ordered=False 時依完成順序輸出。
+    on_failure(level, file name, message) 會在每筆失敗寫log時被呼叫。
+    cache_path: sqlite cache檔，沒改過的doc直接用cache結果(see cache.py)。
+    sections: 只抓這些section內的表格(see tools.SECTIONS)，None為全文。
+    doc_budget: 每份doc的秒數上限，超過的doc放棄；cell_budget: 超過這個字數的cell不抽取。
+    prefilter: 跳過不可能有結果的doc和cell，跳過的數量記在prefilter_skipped_doc, prefilter_skipped_cell。
+    path可以是檔案、目錄(含子目錄)或zip/tar(.gz/.xz)壓縮檔，include, exclude: glob patterns of names,
+    see sources.iter_texts。prefetch: 背景thread預先讀取的doc數，0為不用thread。
+    memo_sizes: tuple(tables, matches) 設定memo大小(see memo.configure)，None為不變。
+    memo_shared: workers共用table memo。
+    shard: (i, N) 只處理第i份doc；positions: list, append (不分shard時的順序, name)，see merge.py。
+    documents: iterable of (name, text)，給了就不讀path(see watch.py)，stats: 它的ReadStats。
+    統計merge到 run_metrics (count)，run_metrics.enabled 時記錄各stage時間；讀檔統計merge到 read_stats，
+    memo hit/miss merge到 memo_count。"""
+    if stats is None:
+        stats = sources.ReadStats()
+    if documents is None:
+        DIR = path if path is not None else sys.argv[1]
+        documents = sources.iter_texts(DIR, include, exclude, recursive, stats, shard=shard, positions=positions)
+        if documents is None:
+            print('only accept a file or a dir path')
+            return
+    documents = _timed_read(documents)
+    if prefetch:
+        documents = sources.prefetch(documents, prefetch)
+
+    process = functools.partial(process_document,
+                                extract_accuseds=extract_accuseds,
+                                extract_sentences=extract_sentences,
+                                cache_path=cache_path,
+                                sections=sections,
+                                timed=run_metrics.enabled,
+                                doc_budget=doc_budget,
+                                cell_budget=cell_budget,
+                                prefilter=prefilter)
+    if memo_sizes is not None:
+        memo.configure(*memo_sizes)
+    if workers > 1:
+        sizes = memo_sizes if memo_sizes is not None else (memo.tables.maxsize, memo.matches.maxsize)
+        manager = multiprocessing.Manager() if memo_shared else None
+        shared = manager.dict() if manager is not None else None
+        try:
+            for res in _pool_main(process, documents, workers, chunksize, ordered, on_failure, stats, sizes, shared):
+                yield res
+        finally:
+            if manager is not None:
+                manager.shutdown()
+    else:
+        for res in _collect(map(process, documents), on_failure, stats):
+            yield res
+    run_metrics.count({'read_bytes': stats.bytes, 'decode_fail': len(stats.decode_failures)})
+    read_stats.merge(stats)
+
+
+def _pool_main(process, documents, workers, chunksize, ordered, on_failure, stats, memo_sizes, shared):
+    with multiprocessing.Pool(workers, memo.configure, tuple(memo_sizes) + (shared,)) as pool:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for res in _collect(imap(process, documents, chunksize), on_failure, stats):
+            yield res
+
+
+def _report(level, name, message, on_failure):
+    log.log(level, message)
+    if on_failure is not None:
+        on_failure(level, name, message)
+
+
+def memo_summary(counts=None):
+    """memo_count (or counts summed from several runs) with hit rates."""
+    summary = dict(memo_count if counts is None else counts)
+    for kind in ('table', 'cell'):
+        hits, misses = summary[kind + '_memo_hit'], summary[kind + '_memo_miss']
+        summary[kind + '_hit_rate'] = hits / (hits + misses) if hits + misses else 0.0
+    return summary
+
+
+def _timed_read(documents):
+    """record the 'read' stage of each document in run_metrics."""
+    documents = iter(documents)
+    while True:
+        start = time.perf_counter()
+        try:
+            document = next(documents)
+        except StopIteration:
+            return
+        if run_metrics.enabled:
+            run_metrics.observe('read', time.perf_counter() - start)
+        yield document
+
+
+def _collect(processed, on_failure=None, stats=None):
+    """merge per-doc counts and failure logs into this process, yield results.
+    stats: ReadStats of the reader, 解碼失敗在那個doc的結果之前報告(依完成順序時可能在最後)。
+    """
+    decode_failures = stats.decode_failures if stats is not None else []
+    reported = 0
+    for filename, result, doc_count, failures, timings in processed:
+        if reported < len(decode_failures) and decode_failures[reported] == filename:
+            _report(logging.WARNING, filename, FAILURE_MESSAGES['decode'].format(filename), on_failure)
+            reported += 1
+        for level, name, message in failures:
+            _report(level, name, message, on_failure)
+        for key in memo_count:
+            memo_count[key] += doc_count.pop(key, 0)
+        run_metrics.count(doc_count)
+        run_metrics.observe_document(filename, timings)
+        if result is not None:
+            yield result
+    for name in decode_failures[reported:]:
+        _report(logging.WARNING, name, FAILURE_MESSAGES['decode'].format(name), on_failure)
+
+
+def dump_ndjson(obj, f):
+    """write obj as one compact json line and flush."""
+    f.write(json.dumps(obj, ensure_ascii=False, separators=(',', ':')))
+    f.write('\n')
+    f.flush()
+
+
+def parse_sections(value):
+    sections = value.split(',')
+    for name in sections:
+        if name not in tools.SECTIONS:
+            raise argparse.ArgumentTypeError('unknown section {}, choices: {}'.format(name, ','.join(tools.SECTIONS)))
+    return sections
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='抽取宣告刑')
+    parser.add_argument('path', help='file, directory or zip/tar(.gz/.xz) archive')
+    parser.add_argument('--include', action='append', help='only names matching this glob, e.g. "*.txt"; repeatable')
+    parser.add_argument('--exclude', action='append', help='skip names matching this glob; repeatable')
+    parser.add_argument('--no-recursive', action='store_true', help='only files at top level of the directory')
+    parser.add_argument('--prefetch', type=int, default=64,
+                        help='documents read ahead in a background thread, 0 to read in the main thread')
+    parser.add_argument('--shard', type=sources.parse_shard,
+                        help='i/N: only process documents whose name hashes to shard i of N, see merge.py')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep polling the directory and extract added or changed files, see watch.py')
+    parser.add_argument('--watch-index', default=watch.DEFAULT_PATH,
+                        help='index of processed files, a restart resumes from it')
+    parser.add_argument('--watch-interval', type=float, default=2.0, help='seconds between polls')
+    parser.add_argument('--watch-settle', type=float, default=1.0,
+                        help='skip files modified within this many seconds until the next poll')
+    parser.add_argument('--watch-polls', type=int, help='stop after this many polls, default never')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--chunksize', type=int, default=1, help='files sent to a worker at a time')
+    parser.add_argument('--unordered', action='store_true', help='output in order of completion')
+    parser.add_argument('--format', choices=['json', 'ndjson'], default='json',
+                        help='json: pretty-printed (default); ndjson: one compact record per line')
+    parser.add_argument('--output', help='result file, default stdout')
+    parser.add_argument('--stats', help='sidecar ndjson file for failures and the final count')
+    parser.add_argument('--sqlite', help='also write the results to this sqlite store, see resultstore.py')
+    parser.add_argument('--penalties', help='also decode the sentences into numpy arrays saved to this .npz, '
+                                            'see penalty.py')
+    parser.add_argument('--sections', type=parse_sections,
+                        help='only extract tables in these comma separated sections, e.g. abstract,ending; '
+                             'choices: ' + ','.join(tools.SECTIONS))
+    parser.add_argument('--cache', default=cache.DEFAULT_PATH, help='result cache file')
+    parser.add_argument('--no-cache', action='store_true', help='re-extract every document')
+    parser.add_argument('--doc-budget', type=float, help='give up a document after this many seconds')
+    parser.add_argument('--cell-budget', type=int, help='skip cells longer than this many characters')
+    parser.add_argument('--memo-tables', type=int, default=memo.DEFAULT_TABLES,
+                        help='parsed tables kept in the in-process memo, 0 to disable')
+    parser.add_argument('--memo-cells', type=int, default=memo.DEFAULT_MATCHES,
+                        help='(accused, cell) match results kept in the in-process memo, 0 to disable')
+    parser.add_argument('--memo-shared', action='store_true', help='share the table memo between workers')
+    parser.add_argument('--no-prefilter', action='store_true',
+                        help='run the full pipeline on every document and cell, e.g. to check the prefilter')
+    parser.add_argument('--log', default='extract_declared_sentence.log', help='log file')
+    parser.add_argument('--log-level', default='INFO', help='log level, default INFO')
+    parser.add_argument('--metrics', help='write counters, stage timings and the slowest documents to this file')
+    parser.add_argument('--metrics-format', choices=['json', 'prometheus'], default='json')
+    args = parser.parse_args(argv)
+    if args.penalties and penalty.np is None:
+        parser.error('--penalties needs numpy')
+    if args.watch and (args.shard or args.unordered or not os.path.isdir(args.path)):
+        parser.error('--watch needs a directory and cannot be used with --shard or --unordered')
+    return args
+
+
+def cli(argv=None):
+    args = parse_args(argv)
+    mode = 'a' if args.watch else 'w'  # --watch append到之前的結果和log後面
+    logging.basicConfig(filename=args.log, filemode=mode, level=args.log_level)
+    run_metrics.enabled = args.metrics is not None
+    out = open(args.output, mode, encoding='utf-8') if args.output else sys.stdout
+    stats = open(args.stats, mode, encoding='utf-8') if args.stats else None
+    # --watch 每份doc一個transaction，結果馬上查得到
+    store = resultstore.ResultStoreWriter(args.sqlite, 1 if args.watch else resultstore.DEFAULT_BATCH) \
+        if args.sqlite else None
+    penalties = penalty.Collector() if args.penalties else None
+
+    positions = [] if args.shard else None
+
+    def on_failure(level, filename, message):
+        dump_ndjson({'failure': filename, 'level': logging.getLevelName(level), 'message': message}, stats)
+
+    memo.configure(args.memo_tables, args.memo_cells)  # 只設定一次，--watch每次poll的memo不清掉
+    run = functools.partial(main, path=args.path, workers=args.workers, chunksize=args.chunksize,
+                            ordered=not args.unordered, on_failure=on_failure if stats else None,
+                            cache_path=None if args.no_cache else args.cache, sections=args.sections,
+                            doc_budget=args.doc_budget, cell_budget=args.cell_budget,
+                            prefilter=not args.no_prefilter, include=args.include, exclude=args.exclude,
+                            recursive=not args.no_recursive, prefetch=args.prefetch,
+                            memo_shared=args.memo_shared, shard=args.shard, positions=positions)
+    if args.watch:
+        results = watch.run(args.path, lambda documents, read: run(documents=documents, stats=read),
+                            args.watch_index, args.watch_interval, args.watch_settle, args.watch_polls,
+                            args.include, args.exclude, not args.no_recursive)
+    else:
+        results = run()
+
+    try:
+        try:
+            for res in results:
+                if args.format == 'ndjson':
+                    dump_ndjson(res, out)
                 else:
-                    pass
+                    res_json = json.dumps(res, indent=5, ensure_ascii=False)
+                    print(res_json, file=out, flush=args.watch)
+                    # pprint.pprint(res)
+                if store is not None:
+                    store.add(res)
+                if penalties is not None:
+                    penalties.add(res)
+        except KeyboardInterrupt:
+            if not args.watch:
+                raise
 
+        summary = {'count': count, 'read': read_stats.to_dict(), 'memo': memo_summary()}
+        if args.shard:
+            summary.update(shard=list(args.shard), unordered=args.unordered, documents=positions)
+        if stats:
+            dump_ndjson(summary, stats)
+        elif args.format == 'ndjson':
+            dump_ndjson(summary, sys.stderr)
+        else:
+            print('統計：', file=out)
+            pprint.pprint(count, stream=out)
+            print('讀取：{bytes} bytes, {bytes_per_second:.0f} bytes/s, encodings {encodings}'.format(
+                **read_stats.to_dict()), file=out)
+            print('memo：table hit rate {table_hit_rate:.1%}, cell hit rate {cell_hit_rate:.1%}'.format(
+                **memo_summary()), file=out)
 
-if __name__ == "__main__":
-    for res in main():
-        res_json = json.dumps(res, indent=5, ensure_ascii=False)
-        print(res_json)
-        # pprint.pprint(res)
+        if penalties is not None:
+            penalties.save(args.penalties)
+        if args.metrics:
+            with open(args.metrics, 'w', encoding='utf-8') as f:
+                f.write(run_metrics.to_json() if args.metrics_format == 'json' else run_metrics.to_prometheus())
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if stats:
+            stats.close()
+        if store is not None:
+            store.close()
 
-    print('統計：')
-    pprint.pprint(count)
+
+if __name__ == "__main__":
+    cli()
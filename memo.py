@@ -0,0 +1,110 @@
+"""
+In-process LRU memo of parsed tables and sentence matches.
+
+同一個法院的判決常有一模一樣的附表和cell，同內容的table只parse一次，
+同一個被告和同內容的cell只掃一次。key是內容的hash(和被告名字)，結果和不用memo時完全相同。
+回傳的list是memo內結果的copy，caller修改不會影響之後的doc。
+
+    memo.configure(tables=4096, matches=65536)   # 0為不用
+    memo.stats()  # {'table_memo_hit': ..., 'table_memo_miss': ..., 'cell_memo_hit': ..., 'cell_memo_miss': ...}
+
+process pool的每個worker各有一份；configure(shared=...) 給 multiprocessing.Manager().dict() 時
+table memo也會查寫這個跨process的dict(每次查詢都是IPC，所以cell memo不共用)。
+"""
+import collections
+import hashlib
+
+
+DEFAULT_TABLES = 4096
+DEFAULT_MATCHES = 65536
+
+
+def content_hash(text):
+    return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+
+class LRU(object):
+    """bounded LRU dict with hit/miss counts. maxsize 0 disables it."""
+
+    def __init__(self, maxsize, shared=None):
+        self.maxsize = maxsize
+        self.shared = shared
+        self.shared_puts = 0
+        self.data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """:return: value or None"""
+        if not self.maxsize:
+            return None
+        value = self.data.get(key)
+        if value is not None:
+            self.data.move_to_end(key)
+        elif self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self._store(key, value)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if not self.maxsize:
+            return
+        self._store(key, value)
+        # 每個process最多寫maxsize筆，shared dict不會無限長大
+        if self.shared is not None and self.shared_puts < self.maxsize:
+            self.shared[key] = value
+            self.shared_puts += 1
+
+    def _store(self, key, value):
+        self.data[key] = value
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
+        self.hits = self.misses = 0
+
+
+tables = LRU(DEFAULT_TABLES)
+matches = LRU(DEFAULT_MATCHES)
+
+
+def configure(tables=DEFAULT_TABLES, matches=DEFAULT_MATCHES, shared=None):
+    """resize the memos of this process, shared: dict-like shared by processes for the table memo."""
+    globals()['tables'] = LRU(tables, shared)
+    globals()['matches'] = LRU(matches)
+
+
+def stats():
+    """hit and miss counts of this process, as counters."""
+    return {'table_memo_hit': tables.hits, 'table_memo_miss': tables.misses,
+            'cell_memo_hit': matches.hits, 'cell_memo_miss': matches.misses}
+
+
+def table_cells(text, start, end, parse):
+    """cells of table text[start:end], parse(text, start, end) -> cells when not memoized.
+    :return: a new list
+    """
+    key = content_hash(text[start:end])
+    cells = tables.get(key)
+    if cells is None:
+        cells = parse(text, start, end)
+        tables.put(key, cells)
+    return list(cells)
+
+
+def cell_matches(accused, cell, match):
+    """match(cell) -> list of (charge, sentence) of accused when not memoized.
+    :return: a new list
+    """
+    key = (accused, content_hash(cell))
+    pairs = matches.get(key)
+    if pairs is None:
+        pairs = match(cell)
+        matches.put(key, pairs)
+    return list(pairs)
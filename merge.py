@@ -0,0 +1,151 @@
+"""
+Merge the NDJSON outputs and stats sidecars of `extract_declared_sentence.py --shard i/N` runs.
+
+usage:
+    python3 extract_declared_sentence.py <path> --shard 0/2 --format ndjson --output 0.ndjson --stats 0.stats.ndjson
+    python3 extract_declared_sentence.py <path> --shard 1/2 --format ndjson --output 1.ndjson --stats 1.stats.ndjson
+    python3 merge.py 0.ndjson 1.ndjson --shard-stats 0.stats.ndjson 1.stats.ndjson \
+        --output result.ndjson --stats stats.ndjson
+
+每個shard的stats最後一行記錄了它處理的doc在不分shard時的順序，
+合併後的結果、失敗列表和統計和單機跑(同樣參數，沒有--shard)的輸出相同；
+只有秒數、bytes/s 和memo hit/miss不同。--unordered 跑的shard依shard順序接起來。
+"""
+import argparse
+import heapq
+import json
+import sys
+
+import extract_declared_sentence
+
+
+def read_ndjson(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def read_shard(output_path, stats_path):
+    """:return: dict with records, failures, summary (the last line of the stats sidecar)."""
+    lines = read_ndjson(stats_path)
+    if not lines or 'documents' not in lines[-1]:
+        raise ValueError('{} is not the stats of a --shard run'.format(stats_path))
+    return {'records': read_ndjson(output_path), 'failures': lines[:-1], 'summary': lines[-1]}
+
+
+def _positions(names, documents):
+    """
+    position of each name, names are in the order of documents (a subsequence, same name may repeat).
+    :return: list of position, None for names not found
+    """
+    positions = []
+    i = 0
+    last = None
+    for name in names:
+        if last is not None and documents[last][1] == name:
+            positions.append(documents[last][0])
+            continue
+        while i < len(documents) and documents[i][1] != name:
+            i += 1
+        if i < len(documents):
+            last = i
+            positions.append(documents[i][0])
+            i += 1
+        else:
+            positions.append(None)
+    return positions
+
+
+def _check(shards):
+    indexes = sorted(shard['summary']['shard'][0] for shard in shards)
+    counts = {shard['summary']['shard'][1] for shard in shards}
+    if len(counts) != 1 or indexes != list(range(counts.pop())):
+        raise ValueError('shards {} do not cover 0/N ~ N-1/N exactly once'.format(
+            [shard['summary']['shard'] for shard in shards]))
+
+
+def _ordered(shards, items, name_of):
+    """merge items of all shards by position; items whose name is not found go last."""
+    streams = []
+    leftovers = []
+    for k, shard in enumerate(sorted(shards, key=lambda shard: shard['summary']['shard'][0])):
+        positions = _positions([name_of(item) for item in shard[items]], shard['summary']['documents'])
+        if shard['summary'].get('unordered'):
+            positions = [None] * len(positions)
+        stream = []
+        for order, (position, item) in enumerate(zip(positions, shard[items])):
+            if position is None:
+                leftovers.append(item)
+            else:
+                stream.append((position, k, order, item))
+        streams.append(stream)
+    return [item for _, _, _, item in heapq.merge(*streams)] + leftovers
+
+
+def _sum(dicts):
+    """sum dicts of numbers key by key, in the key order of the first."""
+    total = {}
+    for d in dicts:
+        for key, value in d.items():
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+def merge_summaries(shards):
+    summaries = [shard['summary'] for shard in shards]
+    read = _sum({key: value for key, value in summary['read'].items()
+                 if key in ('files', 'bytes', 'seconds')} for summary in summaries)
+    read['bytes_per_second'] = read['bytes'] / read['seconds'] if read['seconds'] else 0.0
+    read['encodings'] = _sum(summary['read']['encodings'] for summary in summaries)
+    read['decode_failures'] = _ordered([dict(shard, names=shard['summary']['read']['decode_failures'])
+                                        for shard in shards], 'names', lambda name: name)
+    memo_counts = _sum({key: value for key, value in summary['memo'].items() if not key.endswith('_rate')}
+                       for summary in summaries)
+    return {'count': _sum(summary['count'] for summary in summaries),
+            'read': read,
+            'memo': extract_declared_sentence.memo_summary(memo_counts)}
+
+
+def merge(shards):
+    """
+    :param shards: list of read_shard results
+    :return: tuple(records, failures, summary) in the order of a single run
+    """
+    _check(shards)
+    records = _ordered(shards, 'records', lambda record: record[0])
+    failures = _ordered(shards, 'failures', lambda failure: failure['failure'])
+    return records, failures, merge_summaries(shards)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='merge the outputs of --shard runs')
+    parser.add_argument('outputs', nargs='+', help='NDJSON output of each shard')
+    parser.add_argument('--shard-stats', nargs='+', required=True, help='stats sidecar of each shard, same order')
+    parser.add_argument('--output', help='merged NDJSON output, default stdout')
+    parser.add_argument('--stats', help='merged stats sidecar, default stderr')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if len(args.outputs) != len(args.shard_stats):
+        raise SystemExit('got {} outputs but {} stats files'.format(len(args.outputs), len(args.shard_stats)))
+
+    records, failures, summary = merge([read_shard(output, stats)
+                                        for output, stats in zip(args.outputs, args.shard_stats)])
+    out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    stats = open(args.stats, 'w', encoding='utf-8') if args.stats else sys.stderr
+    try:
+        for record in records:
+            extract_declared_sentence.dump_ndjson(record, out)
+        for failure in failures:
+            extract_declared_sentence.dump_ndjson(failure, stats)
+        extract_declared_sentence.dump_ndjson(summary, stats)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if stats is not sys.stderr:
+            stats.close()
+
+
+if __name__ == "__main__":
+    main()
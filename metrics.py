@@ -0,0 +1,214 @@
+"""
+Counters, per-stage timings and slowest documents of an extraction run.
+
+Metrics之間可以merge(例如每個worker process或每個shard各自一份)，
+輸出成json或Prometheus text format。沒開(enabled=False)時只記counters。
+"""
+import bisect
+import heapq
+import json
+import time
+
+
+STAGES = ('read', 'normalize', 'accused', 'locate_tables', 'extract_rows', 'parse', 'sentences', 'document')
+
+# histogram bucket upper bounds in seconds: 1us ~ 1000s, 每格乘sqrt(2)
+BUCKETS = [1e-6 * 2 ** (i / 2) for i in range(61)]
+
+
+class _NullLap(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_LAP = _NullLap()
+
+
+class _Lap(object):
+    __slots__ = ('timings', 'stage', 'start')
+
+    def __init__(self, timings, stage):
+        self.timings = timings
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timings[self.stage] = self.timings.get(self.stage, 0.0) + time.perf_counter() - self.start
+        return False
+
+
+class Stopwatch(object):
+    """
+    累加每個stage的秒數到timings dict；timings為None時什麼都不做。
+
+    stopwatch = Stopwatch(timings)
+    with stopwatch('parse'):
+        ...
+    """
+    __slots__ = ('timings',)
+
+    def __init__(self, timings):
+        self.timings = timings
+
+    def __call__(self, stage):
+        if self.timings is None:
+            return _NULL_LAP
+        return _Lap(self.timings, stage)
+
+
+class Timing(object):
+    """count, sum, max and a fixed bucket histogram of one stage; mergeable."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)  # last one is +Inf
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def percentile(self, q):
+        """upper bound of the bucket containing the q-th (0~1) observation."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count, 'total': self.total, 'max': self.max, 'buckets': self.buckets}
+
+    @classmethod
+    def from_dict(cls, d):
+        timing = cls()
+        timing.count = d['count']
+        timing.total = d['total']
+        timing.max = d['max']
+        timing.buckets = list(d['buckets'])
+        return timing
+
+
+class Metrics(object):
+    """
+    counters: dict of counter name -> int.
+    timings: dict of stage name (see STAGES) -> Timing.
+    slowest: the n slowest documents by 'document' seconds.
+    """
+
+    def __init__(self, counters=(), enabled=True, slowest=10):
+        self.enabled = enabled
+        self.counters = dict.fromkeys(counters, 0)
+        self.timings = {}
+        self.n_slowest = slowest
+        self._slowest = []  # min heap of (seconds, name)
+
+    def count(self, counts):
+        """add a dict of counter name -> n."""
+        for key, n in counts.items():
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, stage, seconds):
+        if stage not in self.timings:
+            self.timings[stage] = Timing()
+        self.timings[stage].observe(seconds)
+
+    def observe_document(self, name, timings):
+        """record the stage timings of one document, e.g. from Stopwatch."""
+        if not self.enabled or not timings:
+            return
+        for stage, seconds in timings.items():
+            self.observe(stage, seconds)
+        if 'document' in timings:
+            self._push_slowest(timings['document'], name)
+
+    def _push_slowest(self, seconds, name):
+        if len(self._slowest) < self.n_slowest:
+            heapq.heappush(self._slowest, (seconds, name))
+        elif seconds > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, (seconds, name))
+
+    def slowest(self):
+        """:return: list of (seconds, document name), slowest first."""
+        return sorted(self._slowest, reverse=True)
+
+    def merge(self, other):
+        self.count(other.counters)
+        for stage, timing in other.timings.items():
+            if stage not in self.timings:
+                self.timings[stage] = Timing()
+            self.timings[stage].merge(timing)
+        for seconds, name in other._slowest:
+            self._push_slowest(seconds, name)
+
+    def to_dict(self):
+        return {'counters': dict(self.counters),
+                'timings': {stage: timing.to_dict() for stage, timing in self.timings.items()},
+                'slowest': [[seconds, name] for seconds, name in self.slowest()]}
+
+    @classmethod
+    def from_dict(cls, d, slowest=10):
+        metrics = cls(slowest=slowest)
+        metrics.counters = dict(d['counters'])
+        metrics.timings = {stage: Timing.from_dict(timing) for stage, timing in d['timings'].items()}
+        for seconds, name in d['slowest']:
+            metrics._push_slowest(seconds, name)
+        return metrics
+
+    def summary(self):
+        """counters, per stage count/total/mean/p50/p90/p99/max and slowest documents."""
+        stages = {}
+        for stage, timing in self.timings.items():
+            stages[stage] = {'count': timing.count,
+                             'total': timing.total,
+                             'mean': timing.total / timing.count if timing.count else 0.0,
+                             'p50': timing.percentile(0.5),
+                             'p90': timing.percentile(0.9),
+                             'p99': timing.percentile(0.99),
+                             'max': timing.max}
+        return {'counters': dict(self.counters),
+                'stages': stages,
+                'slowest': [{'document': name, 'seconds': seconds} for seconds, name in self.slowest()]}
+
+    def to_json(self):
+        return json.dumps(self.summary(), ensure_ascii=False, indent=2)
+
+    def to_prometheus(self, prefix='extract_declared_sentence'):
+        lines = []
+        for key, n in sorted(self.counters.items()):
+            lines.append('# TYPE {}_{}_total counter'.format(prefix, key))
+            lines.append('{}_{}_total {}'.format(prefix, key, n))
+
+        name = '{}_stage_seconds'.format(prefix)
+        lines.append('# TYPE {} histogram'.format(name))
+        for stage, timing in sorted(self.timings.items()):
+            cumulative = 0
+            for bound, n in zip(BUCKETS + [float('inf')], timing.buckets):
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(name, stage, le, cumulative))
+            lines.append('{}_sum{{stage="{}"}} {!r}'.format(name, stage, timing.total))
+            lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, timing.count))
+        return '\n'.join(lines) + '\n'
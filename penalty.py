@@ -0,0 +1,308 @@
+"""
+Decode sentences into numbers and aggregate them over a corpus with NumPy.
+
+    penalty.decode('處有期徒刑壹年貳月，減為有期徒刑柒月，褫奪公權壹年')
+    # Penalty(penalty=3, months=14.0, reduced_months=7.0, probation_months=nan, deprivation_months=12.0, fine=nan)
+
+    python3 extract_declared_sentence.py <path> --penalties penalties.npz
+    python3 penalty.py arrays penalties.npz result.ndjson ...          # 從json/ndjson輸出轉
+    python3 penalty.py aggregate penalties.npz --by charge --field months
+
+penalty: PENALTIES的index，免刑為exempt(unknown是沒有sentence或認不出主刑)；期間單位為月，日以30日為一月；褫奪公權終身為inf；沒有的欄位為nan；fine為新臺幣元(罰金或併科罰金)。
+易科罰金、易服勞役的折算標準不算。數字可以是阿拉伯數字或中文數字(壹貳參、一二三、拾佰仟萬)。
+
+arrays每一列是一組(doc, 被告, charge, sentence)，sentence為None的也算(penalty為unknown)，document, accused, court, charge為代碼，
+對應的名稱在 documents, accuseds, courts, charges。court是判決書檔名第一個','前的法院代碼(司法院開放資料的檔名，
+e.g. TPDM,109,訴,1,20200101,1.json)，charge是罪名(去掉被告名字和'犯'之前的字)。
+NumPy只有arrays和aggregate需要；沒裝時decode照樣可以用。
+"""
+import argparse
+import array
+import collections
+import json
+import math
+import re
+
+import tools
+
+try:
+    import numpy as np
+except ImportError:  # optional, only for arrays and aggregation
+    np = None
+
+
+PENALTIES = ('unknown', 'death', 'life', 'imprisonment', 'detention', 'fine', 'exempt')
+# 主刑關鍵字，依序找第一個
+_KEYWORDS = (('死刑', 1), ('無期徒刑', 2), ('有期徒刑', 3), ('拘役', 4), ('罰金', 5))
+
+_DIGITS = dict(zip('零〇一壹二貳兩三參叁四肆五伍六陸七柒八捌九玖', [0, 0, 1, 1, 2, 2, 2, 3, 3, 3, 4, 4, 5, 5, 6, 6, 7, 7, 8, 8, 9, 9]))
+_UNITS = {'十': 10, '拾': 10, '百': 100, '佰': 100, '千': 1000, '仟': 1000}
+_SECTIONS = {'萬': 10 ** 4, '億': 10 ** 8}
+_TENS = {'廿': 20, '卅': 30}
+
+NUMBER = '[0-9{}]+'.format(''.join(_DIGITS) + ''.join(_UNITS) + ''.join(_SECTIONS) + ''.join(_TENS))
+_TERM = re.compile(r'(?:({0})年)?又?(?:({0})個?月)?又?(?:({0})日)?'.format(NUMBER))
+_AMOUNT = re.compile(r'新[臺台]幣({})元'.format(NUMBER))
+_CLAUSE = re.compile('[，；。]')
+
+Penalty = collections.namedtuple('Penalty', 'penalty months reduced_months probation_months deprivation_months fine')
+
+
+def parse_number(text):
+    """'壹佰貳拾' -> 120, '三萬五千' -> 35000, '15' -> 15. raise ValueError for other characters."""
+    total = section = 0
+    digit = None
+    for ch in text:
+        if '0' <= ch <= '9':
+            digit = (digit or 0) * 10 + ord(ch) - ord('0')
+        elif ch in _DIGITS:
+            digit = _DIGITS[ch]
+        elif ch in _UNITS:
+            section += (1 if digit is None else digit) * _UNITS[ch]
+            digit = None
+        elif ch in _TENS:
+            section += _TENS[ch]
+        elif ch in _SECTIONS:
+            total += (section + (digit or 0)) * _SECTIONS[ch]
+            section = 0
+            digit = None
+        else:
+            raise ValueError('not a number: {!r}'.format(text))
+    return total + section + (digit or 0)
+
+
+def _term(clause, start):
+    """months of the x年x月x日 at clause[start:], nan if there is none."""
+    match = _TERM.match(clause, start)
+    if not match or not any(match.groups()):
+        return math.nan
+    years, months, days = (parse_number(n) if n else 0 for n in match.groups())
+    return years * 12 + months + days / 30
+
+
+def _after(clause, keyword):
+    return clause.index(keyword) + len(keyword)
+
+
+def _amount(clause, start=0):
+    match = _AMOUNT.search(clause, start)
+    return float(parse_number(match.group(1))) if match else math.nan
+
+
+def decode(sentence):
+    """:return: Penalty of a sentence string, e.g. '處有期徒刑壹年壹月；減為有期徒刑陸月又拾伍日。'
+    先和main()的輸出一樣normalize(褫->禠、全形數字，see tools.normalize_document, normalize_cell)。
+    None(無罪或沒有抽到宣告刑)為 unknown，其他欄位都是nan。"""
+    penalty = 0
+    months = reduced = probation = deprivation = fine = math.nan
+    if sentence is None:
+        return Penalty(penalty, months, reduced, probation, deprivation, fine)
+    sentence = tools.normalize_cell(tools.normalize_document(sentence))
+    for clause in _CLAUSE.split(sentence):
+        if '易科' in clause or '易服' in clause or '折算' in clause:
+            continue
+        if '減為' in clause:
+            start = _after(clause, '減為')
+            reduced = _term(clause, _after(clause, '有期徒刑') if '有期徒刑' in clause[start:] else start)
+            continue
+        if '緩刑' in clause:
+            probation = _term(clause, _after(clause, '緩刑'))
+        if '禠奪公權' in clause:
+            start = _after(clause, '禠奪公權')
+            deprivation = math.inf if clause.startswith('終身', start) else _term(clause, start)
+        if '併科罰金' in clause:
+            fine = _amount(clause, _after(clause, '併科罰金'))
+        elif not penalty and '處' in clause:
+            for keyword, code in _KEYWORDS:
+                if keyword in clause:
+                    penalty = code
+                    if code == 5:
+                        fine = _amount(clause, _after(clause, keyword))
+                    elif code >= 3:
+                        months = _term(clause, _after(clause, keyword))
+                    break
+        elif not penalty and '免刑' in clause:
+            penalty = 6
+    return Penalty(penalty, months, reduced, probation, deprivation, fine)
+
+
+def court_of(name):
+    """'TPDM,109,訴,1,20200101,1.json' -> 'TPDM', '' if the file name has no ','."""
+    base = name.rsplit('/', 1)[-1]
+    return base.split(',', 1)[0] if ',' in base else ''
+
+
+def charge_name(charge, accused=''):
+    """'王小明共同犯行使偽造公文書罪' -> '行使偽造公文書罪'"""
+    if accused and charge.startswith(accused):
+        charge = charge[len(accused):]
+    return charge.split('犯', 1)[1] if '犯' in charge else charge
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError('penalty arrays need numpy: pip install numpy')
+
+
+# column -> array typecode; penalty int8, 期間float32, fine float64, 代碼int32
+COLUMNS = {'document': 'i', 'accused': 'i', 'court': 'i', 'charge': 'i',
+           'penalty': 'b', 'months': 'f', 'reduced_months': 'f', 'probation_months': 'f',
+           'deprivation_months': 'f', 'fine': 'd'}
+_CODED = ('document', 'accused', 'court', 'charge')
+
+
+class Collector(object):
+    """
+    decode main() results row by row into compact columns.
+
+    collector = Collector()
+    for result in extract_declared_sentence.main(path=...):
+        collector.add(result)
+    collector.save('penalties.npz')
+    """
+
+    def __init__(self):
+        self.columns = {column: array.array(typecode) for column, typecode in COLUMNS.items()}
+        self.codes = {column: {} for column in _CODED}
+
+    def __len__(self):
+        return len(self.columns['penalty'])
+
+    def _code(self, column, name):
+        codes = self.codes[column]
+        if name not in codes:
+            codes[name] = len(codes)
+        return codes[name]
+
+    def add(self, result):
+        """:param result: [file name, {accused: [(charge, sentence), ...], ...}]"""
+        name, charge_sentence_pairs = result
+        document = self._code('document', name)
+        court = self._code('court', court_of(name))
+        for accused, pairs in charge_sentence_pairs.items():
+            accused_code = self._code('accused', accused)
+            for charge, sentence in pairs:
+                values = decode(sentence)._asdict()
+                values.update(document=document, accused=accused_code, court=court,
+                              charge=self._code('charge', charge_name(charge, accused)))
+                for column, value in values.items():
+                    self.columns[column].append(value)
+
+    def to_arrays(self):
+        """:return: dict of column -> numpy array, and documents, accuseds, courts, charges -> names."""
+        _require_numpy()
+        arrays = {column: np.array(values, dtype=values.typecode) for column, values in self.columns.items()}
+        for column in _CODED:
+            arrays[column + 's'] = np.array(list(self.codes[column]), dtype=str)
+        return arrays
+
+    def save(self, path):
+        np.savez_compressed(path, **self.to_arrays())
+
+
+def load(path):
+    """:return: dict of arrays saved by Collector.save."""
+    _require_numpy()
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+
+def aggregate(arrays, by='charge', field='months', quantiles=(0.5, 0.9), bins=None):
+    """
+    distribution of field per group, vectorized.
+    :param by: 'charge', 'court', 'accused' or 'document'
+    :param field: 'months', 'reduced_months', 'probation_months', 'deprivation_months' or 'fine';
+        'penalty' counts each penalty type instead.
+    :param bins: edges of a histogram of field, see numpy.digitize
+    :return: dict with keys (group names), rows (rows per group) and
+        for penalty: counts, shape (groups, len(PENALTIES));
+        otherwise: count (finite values), infinite, mean, quantiles {q: array}, histogram shape (groups, len(bins) + 1).
+        沒有值的group的mean, quantile為nan。
+    """
+    _require_numpy()
+    keys = arrays[by + 's']
+    groups = arrays[by].astype(np.intp)
+    n = len(keys)
+    summary = {'keys': keys, 'rows': np.bincount(groups, minlength=n)}
+    values = arrays[field]
+    if field == 'penalty':
+        counts = np.bincount(groups * len(PENALTIES) + values, minlength=n * len(PENALTIES))
+        summary['counts'] = counts.reshape(n, len(PENALTIES))
+        return summary
+
+    finite = np.isfinite(values)
+    summary['infinite'] = np.bincount(groups[np.isinf(values)], minlength=n)
+    groups, values = groups[finite], values[finite].astype(np.float64)
+    count = np.bincount(groups, minlength=n)
+    summary['count'] = count
+    with np.errstate(invalid='ignore', divide='ignore'):
+        summary['mean'] = np.bincount(groups, weights=values, minlength=n) / count
+
+    # 依(group, value)排序後，每個group第k小的值在 start + k；quantile取nearest rank
+    order = np.lexsort((values, groups))
+    ordered = values[order]
+    starts = np.cumsum(count) - count
+    summary['quantiles'] = {}
+    for q in quantiles:
+        index = starts + np.maximum(np.ceil(q * count).astype(np.intp) - 1, 0)
+        picked = ordered[np.minimum(index, len(ordered) - 1)] if len(ordered) else np.full(n, np.nan)
+        summary['quantiles'][q] = np.where(count > 0, picked, np.nan)
+    if bins is not None:
+        width = len(bins) + 1
+        cells = groups * width + np.digitize(values, bins)
+        summary['histogram'] = np.bincount(cells, minlength=n * width).reshape(n, width)
+    return summary
+
+
+def _json_rows(summary, top):
+    """summary of aggregate as a list of dict per group, most rows first."""
+    rows = []
+    for i in np.argsort(-summary['rows'], kind='stable')[:top]:
+        row = {'key': str(summary['keys'][i]), 'rows': int(summary['rows'][i])}
+        if 'counts' in summary:
+            row.update(zip(PENALTIES, summary['counts'][i].tolist()))
+        else:
+            row.update(count=int(summary['count'][i]), infinite=int(summary['infinite'][i]),
+                       mean=_number(summary['mean'][i]))
+            for q, values in summary['quantiles'].items():
+                row['p{:g}'.format(q * 100)] = _number(values[i])
+            if 'histogram' in summary:
+                row['histogram'] = summary['histogram'][i].tolist()
+        rows.append(row)
+    return rows
+
+
+def _number(value):
+    return None if math.isnan(value) else float(value)
+
+
+if __name__ == "__main__":
+    import resultstore
+
+    parser = argparse.ArgumentParser(description='penalty arrays and aggregation')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert = subparsers.add_parser('arrays', help='decode json/ndjson outputs of extract_declared_sentence.py')
+    convert.add_argument('npz_path')
+    convert.add_argument('outputs', nargs='+')
+    agg = subparsers.add_parser('aggregate', help='distribution per group, one json line per group')
+    agg.add_argument('npz_path')
+    agg.add_argument('--by', choices=_CODED, default='charge')
+    agg.add_argument('--field', choices=[column for column in COLUMNS if column not in _CODED], default='months')
+    agg.add_argument('--quantiles', type=lambda value: [float(q) for q in value.split(',')], default=[0.5, 0.9],
+                     help='comma separated, default 0.5,0.9')
+    agg.add_argument('--bins', type=lambda value: [float(b) for b in value.split(',')],
+                     help='comma separated histogram edges, e.g. 6,12,24,60')
+    agg.add_argument('--top', type=int, default=50, help='groups with the most rows')
+    args = parser.parse_args()
+
+    if args.command == 'arrays':
+        collector = Collector()
+        for path in args.outputs:
+            for result in resultstore.read_results(path):
+                collector.add(result)
+        collector.save(args.npz_path)
+        print('{} sentences decoded.'.format(len(collector)))
+    else:
+        summary = aggregate(load(args.npz_path), args.by, args.field, args.quantiles, args.bins)
+        for row in _json_rows(summary, args.top):
+            print(json.dumps(row, ensure_ascii=False))
@@ -0,0 +1,244 @@
+"""
+SQLite store of extraction results, 查詢某罪名、某被告不用再grep整個json輸出。
+
+tables:
+    documents(id, name)                   name unique，同名的doc再寫入時取代舊的(例如 --watch 重新抽取)
+    accused(id, document_id, name)
+    pairs(id, accused_id, charge, sentence)  sentence為NULL: 無罪或沒有抽到宣告刑(main()的(charge, None))
+    charges                               FTS5 trigram index of pairs.charge (SQLite >= 3.34，沒有時用LIKE)
+
+usage:
+    python3 extract_declared_sentence.py <path> --sqlite results.sqlite
+    python3 resultstore.py load results.sqlite result.ndjson ...      # json或ndjson輸出
+    python3 resultstore.py query results.sqlite --charge 詐欺罪 --sentence 緩刑
+    python3 resultstore.py query results.sqlite --accused 王小明
+
+--charge, --sentence 是子字串；三個字以上的charge用FTS，較短的和sentence用LIKE掃描。
+"""
+import argparse
+import json
+import sqlite3
+import sys
+
+
+DEFAULT_BATCH = 1000
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS documents (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS accused (id INTEGER PRIMARY KEY, document_id INTEGER NOT NULL REFERENCES documents(id),
+                                    name TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS pairs (id INTEGER PRIMARY KEY, accused_id INTEGER NOT NULL REFERENCES accused(id),
+                                  charge TEXT NOT NULL, sentence TEXT);
+CREATE INDEX IF NOT EXISTS accused_document ON accused(document_id);
+CREATE INDEX IF NOT EXISTS accused_name ON accused(name);
+CREATE INDEX IF NOT EXISTS pairs_accused ON pairs(accused_id);
+'''
+
+_FTS_SCHEMA = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS charges USING fts5(charge, content='pairs', content_rowid='id', tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS pairs_insert AFTER INSERT ON pairs BEGIN
+    INSERT INTO charges(rowid, charge) VALUES (new.id, new.charge);
+END;
+CREATE TRIGGER IF NOT EXISTS pairs_delete AFTER DELETE ON pairs BEGIN
+    INSERT INTO charges(charges, rowid, charge) VALUES ('delete', old.id, old.charge);
+END;
+'''
+
+FTS_MIN_CHARS = 3  # trigram
+
+
+def connect(path):
+    """:return: (connection, whether the charges FTS index exists), 建立不存在的tables."""
+    db = sqlite3.connect(path, timeout=60, isolation_level=None)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.executescript(_SCHEMA)
+    try:
+        db.executescript(_FTS_SCHEMA)
+    except sqlite3.OperationalError:  # 沒有fts5或trigram tokenizer
+        pass
+    fts = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'charges'").fetchone() is not None
+    return db, fts
+
+
+class ResultStoreWriter(object):
+    """
+    batched writer, 每batch份doc一個transaction.
+
+    with ResultStoreWriter('results.sqlite') as writer:
+        for result in extract_declared_sentence.main(path=...):
+            writer.add(result)
+    """
+
+    def __init__(self, path, batch=DEFAULT_BATCH):
+        self.db, _ = connect(path)
+        self.batch = batch
+        self.pending = []
+
+    def add(self, result):
+        """:param result: [file name, {accused: [(charge, sentence), ...], ...}] as yielded by main()"""
+        self.pending.append(result)
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        cursor = self.db.cursor()
+        cursor.execute('BEGIN')
+        try:
+            for name, charge_sentence_pairs in self.pending:
+                self._delete(cursor, name)
+                cursor.execute('INSERT INTO documents (name) VALUES (?)', (name,))
+                document_id = cursor.lastrowid
+                for accused, pairs in charge_sentence_pairs.items():
+                    cursor.execute('INSERT INTO accused (document_id, name) VALUES (?, ?)', (document_id, accused))
+                    accused_id = cursor.lastrowid
+                    cursor.executemany('INSERT INTO pairs (accused_id, charge, sentence) VALUES (?, ?, ?)',
+                                       [(accused_id, charge, sentence) for charge, sentence in pairs])
+            cursor.execute('COMMIT')
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+        self.pending = []
+
+    @staticmethod
+    def _delete(cursor, name):
+        row = cursor.execute('SELECT id FROM documents WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return
+        cursor.execute('DELETE FROM pairs WHERE accused_id IN (SELECT id FROM accused WHERE document_id = ?)', row)
+        cursor.execute('DELETE FROM accused WHERE document_id = ?', row)
+        cursor.execute('DELETE FROM documents WHERE id = ?', row)
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _like(text):
+    return '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+class ResultStore(object):
+    """read side, see query."""
+
+    def __init__(self, path):
+        self.db, self.fts = connect(path)
+
+    def __len__(self):
+        """number of documents."""
+        return self.db.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+
+    def query(self, charge=None, sentence=None, accused=None, document=None, limit=None):
+        """
+        :param charge, sentence: substring of the charge / sentence
+        :param accused, document: exact name of the accused / document
+        :return: list of dict(document, accused, charge, sentence), 依寫入順序
+        """
+        where = []
+        params = []
+        if charge:
+            if self.fts and len(charge) >= FTS_MIN_CHARS:
+                where.append('pairs.id IN (SELECT rowid FROM charges WHERE charges MATCH ?)')
+                params.append('"{}"'.format(charge.replace('"', '""')))
+            else:
+                where.append("pairs.charge LIKE ? ESCAPE '\\'")
+                params.append(_like(charge))
+        if sentence:
+            where.append("pairs.sentence LIKE ? ESCAPE '\\'")
+            params.append(_like(sentence))
+        if accused:
+            where.append('accused.name = ?')
+            params.append(accused)
+        if document:
+            where.append('documents.name = ?')
+            params.append(document)
+        sql = ('SELECT documents.name, accused.name, pairs.charge, pairs.sentence FROM pairs '
+               'JOIN accused ON accused.id = pairs.accused_id JOIN documents ON documents.id = accused.document_id')
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY pairs.id'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return [{'document': row[0], 'accused': row[1], 'charge': row[2], 'sentence': row[3]}
+                for row in self.db.execute(sql, params)]
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_results(path):
+    """results in a json (pretty-printed) or ndjson output of extract_declared_sentence.py, 到統計之前為止。"""
+    with open(path, encoding='utf-8') as f:
+        first = f.readline()
+        try:
+            yield json.loads(first)
+        except ValueError:  # json: 多個縮排過的array接在一起
+            text = first + f.read()
+            decoder = json.JSONDecoder()
+            end = 0
+            while True:
+                while end < len(text) and text[end].isspace():
+                    end += 1
+                try:
+                    result, end = decoder.raw_decode(text, end)
+                except ValueError:
+                    return
+                yield result
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def load(store_path, paths, batch=DEFAULT_BATCH):
+    """:return: number of documents loaded."""
+    n = 0
+    with ResultStoreWriter(store_path, batch) as writer:
+        for path in paths:
+            for result in read_results(path):
+                writer.add(result)
+                n += 1
+    return n
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='result store tools')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    load_parser = subparsers.add_parser('load', help='load json/ndjson outputs of extract_declared_sentence.py')
+    load_parser.add_argument('store_path')
+    load_parser.add_argument('outputs', nargs='+')
+    load_parser.add_argument('--batch', type=int, default=DEFAULT_BATCH, help='documents per transaction')
+    query = subparsers.add_parser('query', help='print matching (document, accused, charge, sentence) as ndjson')
+    query.add_argument('store_path')
+    query.add_argument('--charge', help='substring of the charge, e.g. 詐欺罪')
+    query.add_argument('--sentence', help='substring of the sentence, e.g. 緩刑')
+    query.add_argument('--accused', help='name of the accused')
+    query.add_argument('--document', help='file name of the document')
+    query.add_argument('--limit', type=int)
+    query.add_argument('--count', action='store_true', help='only print the number of matches')
+    args = parser.parse_args()
+
+    if args.command == 'load':
+        print('{} docs loaded.'.format(load(args.store_path, args.outputs, args.batch)))
+    else:
+        with ResultStore(args.store_path) as store:
+            rows = store.query(args.charge, args.sentence, args.accused, args.document, args.limit)
+        if args.count:
+            print(len(rows))
+        else:
+            for row in rows:
+                sys.stdout.write(json.dumps(row, ensure_ascii=False) + '\n')
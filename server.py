@@ -0,0 +1,298 @@
+"""
+Long-running extraction service: patterns, memo, cache and worker processes stay warm between requests.
+
+usage:
+    python3 server.py --stdio [--workers 4]          # JSON lines on stdin/stdout
+    python3 server.py --http 127.0.0.1:8080          # POST /extract, GET /stats
+
+request:  {"id": 1, "name": "doc.txt", "text": "..."}  (stdio: {"id": 2, "stats": true} 查統計)
+response: {"id": 1, "result": [name, {accused: [[charge, sentence], ...]}] or null,
+           "failures": [{"failure": name, "level": "WARNING", "message": ...}], "seconds": 0.01}
+
+result和main()的輸出相同，failures和 --stats 的格式相同。stdio依完成順序回應，用id對應。
+同時處理中的request最多 --max-pending 個：stdio超過時停止讀stdin，HTTP超過時回503和Retry-After。
+統計(count, memo, 每個request的latency p50/p99)在 GET /stats。
+"""
+import argparse
+import concurrent.futures
+import functools
+import http.server
+import json
+import logging
+import multiprocessing
+import sys
+import threading
+import time
+
+import cache
+import extract_declared_sentence
+import memo
+import metrics
+import tools
+
+
+log = logging.getLogger(__name__)
+
+
+class Busy(Exception):
+    """max_pending requests are already in flight."""
+
+
+class Service(object):
+    """
+    process (name, text) requests with process_document, in a process pool if workers > 1
+    (否則在一個背景thread，memo和sqlite cache都不是thread-safe)。
+    options: keyword args of process_document, e.g. cache_path, sections, doc_budget.
+    統計merge到 extract_declared_sentence 的 run_metrics 和 memo_count。
+    """
+
+    def __init__(self, workers=1, max_pending=64, memo_sizes=None, **options):
+        self.process = functools.partial(extract_declared_sentence.process_document,
+                                         timed=extract_declared_sentence.run_metrics.enabled, **options)
+        sizes = memo_sizes if memo_sizes is not None else (memo.tables.maxsize, memo.matches.maxsize)
+        if workers > 1:
+            self.pool = multiprocessing.Pool(workers, memo.configure, tuple(sizes))
+            self.executor = None
+        else:
+            memo.configure(*sizes)
+            self.pool = None
+            self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.max_pending = max_pending
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()  # run_metrics, memo_count and the fields below
+        self.pending = 0
+        self.rejected = 0
+        self.errors = 0
+        self.latency = metrics.Timing()
+
+    def submit(self, name, text, block=True):
+        """
+        :param block: 已有max_pending個request時等待，False時raise Busy。
+        :return: concurrent.futures.Future of the response dict (see module doc, without id).
+        """
+        if not self.slots.acquire(blocking=block):
+            with self.lock:
+                self.rejected += 1
+            raise Busy()
+        with self.lock:
+            self.pending += 1
+        future = concurrent.futures.Future()
+        start = time.perf_counter()
+        done = functools.partial(self._done, future, start)
+        try:
+            if self.pool is not None:
+                self.pool.apply_async(self.process, ((name, text),),
+                                      callback=done, error_callback=lambda e: done(None, e))
+            else:
+                self.executor.submit(self.process, (name, text)).add_done_callback(
+                    lambda f: done(None, f.exception()) if f.exception() else done(f.result()))
+        except BaseException:
+            self._release()
+            raise
+        return future
+
+    def extract(self, name, text, block=True):
+        """submit and wait, :return: response dict."""
+        return self.submit(name, text, block).result()
+
+    def _release(self):
+        with self.lock:
+            self.pending -= 1
+        self.slots.release()
+
+    def _done(self, future, start, processed, error=None):
+        failures = []
+
+        def on_failure(level, filename, message):
+            failures.append({'failure': filename, 'level': logging.getLevelName(level), 'message': message})
+
+        try:
+            if error is not None:
+                raise error
+            with self.lock:
+                results = list(extract_declared_sentence._collect([processed], on_failure))
+                seconds = time.perf_counter() - start
+                self.latency.observe(seconds)
+            response = {'result': results[0] if results else None, 'failures': failures, 'seconds': seconds}
+        except Exception as e:
+            log.exception('request failed')
+            with self.lock:
+                self.errors += 1
+            response = {'error': '{}: {}'.format(type(e).__name__, e)}
+        self._release()
+        future.set_result(response)
+
+    def stats(self):
+        """count, memo hit rates, request latency and stage timings so far."""
+        run_metrics = extract_declared_sentence.run_metrics
+        with self.lock:
+            latency = self.latency
+            return {'count': dict(run_metrics.counters),
+                    'memo': extract_declared_sentence.memo_summary(),
+                    'requests': {'count': latency.count, 'pending': self.pending, 'max_pending': self.max_pending,
+                                 'rejected': self.rejected, 'errors': self.errors},
+                    'latency': {'mean': latency.total / latency.count if latency.count else 0.0,
+                                'p50': latency.percentile(0.5),
+                                'p90': latency.percentile(0.9),
+                                'p99': latency.percentile(0.99),
+                                'max': latency.max},
+                    'stages': run_metrics.summary()['stages']}
+
+    def close(self):
+        """wait for the requests in flight and stop the workers."""
+        for _ in range(self.max_pending):
+            self.slots.acquire()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        else:
+            self.executor.shutdown()
+
+
+def parse_request(line):
+    """:return: request dict with name and text (or stats), raise ValueError if it is neither."""
+    request = json.loads(line)
+    if not isinstance(request, dict):
+        raise ValueError('request must be a json object')
+    if not request.get('stats') and not isinstance(request.get('text'), str):
+        raise ValueError('request needs a "text" string')
+    if not isinstance(request.setdefault('name', ''), str):
+        raise ValueError('"name" must be a string')
+    return request
+
+
+def serve_lines(service, lines, out):
+    """stdio protocol: one request per line, responses written in order of completion. 讀到EOF後等全部完成。"""
+    write_lock = threading.Lock()
+
+    def write(response):
+        with write_lock:
+            extract_declared_sentence.dump_ndjson(response, out)
+
+    def respond(request_id, future):
+        write(dict(future.result(), id=request_id))
+
+    for line in lines:
+        if not line.strip():
+            continue
+        request_id = None
+        try:
+            request = parse_request(line)
+            request_id = request.get('id')
+        except ValueError as e:
+            write({'id': request_id, 'error': 'bad request: {}'.format(e)})
+            continue
+        if request.get('stats'):
+            write(dict(service.stats(), id=request_id))
+            continue
+        future = service.submit(request['name'], request['text'])
+        future.add_done_callback(functools.partial(respond, request_id))
+    service.close()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """POST /extract, GET /stats. server.service is the Service."""
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._send(200, self.server.service.stats())
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/extract':
+            self._send(404, {'error': 'not found'})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            request = parse_request(body.decode('utf-8'))
+            if request.get('stats'):
+                raise ValueError('use GET /stats')
+        except (ValueError, UnicodeDecodeError) as e:
+            self._send(400, {'error': 'bad request: {}'.format(e)})
+            return
+        try:
+            response = self.server.service.extract(request['name'], request['text'], block=False)
+        except Busy:
+            self._send(503, {'error': 'busy'}, {'Retry-After': '1'})
+            return
+        response['id'] = request.get('id')
+        self._send(500 if 'error' in response else 200, response)
+
+    def _send(self, status, obj, headers=None):
+        body = json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+def make_http_server(service, host='127.0.0.1', port=8080):
+    """ThreadingHTTPServer serving service, call serve_forever() and shutdown()."""
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def parse_address(value):
+    """'host:port' or 'port' -> (host, port)."""
+    host, _, port = value.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='抽取宣告刑 service')
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument('--stdio', action='store_true', help='JSON lines requests on stdin, responses on stdout')
+    mode.add_argument('--http', type=parse_address, metavar='HOST:PORT', help='serve POST /extract and GET /stats')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--max-pending', type=int, default=64,
+                        help='requests in flight before stdin is no longer read / HTTP answers 503')
+    parser.add_argument('--sections', type=extract_declared_sentence.parse_sections,
+                        help='only extract tables in these comma separated sections; '
+                             'choices: ' + ','.join(tools.SECTIONS))
+    parser.add_argument('--cache', default=cache.DEFAULT_PATH, help='result cache file')
+    parser.add_argument('--no-cache', action='store_true', help='re-extract every document')
+    parser.add_argument('--doc-budget', type=float, help='give up a document after this many seconds')
+    parser.add_argument('--cell-budget', type=int, help='skip cells longer than this many characters')
+    parser.add_argument('--memo-tables', type=int, default=memo.DEFAULT_TABLES,
+                        help='parsed tables kept in the in-process memo, 0 to disable')
+    parser.add_argument('--memo-cells', type=int, default=memo.DEFAULT_MATCHES,
+                        help='(accused, cell) match results kept in the in-process memo, 0 to disable')
+    parser.add_argument('--no-prefilter', action='store_true', help='run the full pipeline on every document and cell')
+    parser.add_argument('--log', default='server.log', help='log file, appended to')
+    parser.add_argument('--log-level', default='INFO', help='log level, default INFO')
+    return parser.parse_args(argv)
+
+
+def cli(argv=None, stdin=None, stdout=None):
+    args = parse_args(argv)
+    logging.basicConfig(filename=args.log, filemode='a', level=args.log_level)
+    extract_declared_sentence.run_metrics.enabled = True
+    service = Service(workers=args.workers, max_pending=args.max_pending,
+                      memo_sizes=(args.memo_tables, args.memo_cells),
+                      cache_path=None if args.no_cache else args.cache, sections=args.sections,
+                      doc_budget=args.doc_budget, cell_budget=args.cell_budget, prefilter=not args.no_prefilter)
+    if args.stdio:
+        serve_lines(service, stdin or sys.stdin, stdout or sys.stdout)
+        return
+    server = make_http_server(service, *args.http)
+    log.info('serving on %s:%s', *server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    cli()
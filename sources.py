@@ -0,0 +1,301 @@
+"""
+Input documents as (name, text) pairs, from a file, a directory tree or zip/tar archives.
+
+    for name, text in sources.iter_texts('verdicts.tar.gz', include=['*.txt']):
+        ...
+
+name: 單一檔案為檔名；目錄內為相對路徑('/'分隔)；壓縮檔內為member名稱，
+目錄內的壓縮檔為 '壓縮檔相對路徑/member'。'.'開頭的檔案和目錄跳過。
+
+編碼依序試 UTF-8(含BOM)、CP950、Big5-HKSCS，都不行時以UTF-8加U+FFFD解碼並記在ReadStats。
+大於MMAP_THRESHOLD的檔案用mmap直接解碼，不先複製成bytes。
+"""
+import codecs
+import collections
+import fnmatch
+import hashlib
+import itertools
+import mmap
+import os
+import queue
+import tarfile
+import threading
+import time
+import zipfile
+
+
+ZIP_SUFFIXES = ('.zip',)
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.xz', '.txz', '.tar.bz2', '.tbz2')
+
+
+def is_archive(path):
+    name = path.lower()
+    return name.endswith(ZIP_SUFFIXES) or name.endswith(TAR_SUFFIXES)
+
+
+ENCODINGS = ('utf-8', 'cp950', 'big5hkscs')
+MMAP_THRESHOLD = 1 << 20
+
+
+class ReadStats(object):
+    """bytes and seconds spent reading and decoding, documents per encoding and names that failed to decode."""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.encodings = collections.Counter()
+        self.decode_failures = []
+
+    def bytes_per_second(self):
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def record(self, name, size, encoding, seconds):
+        """one document of size bytes read and decoded with encoding (None: failed) in seconds."""
+        self.files += 1
+        self.bytes += size
+        self.seconds += seconds
+        self.encodings[encoding] += 1
+        if encoding is None:
+            self.decode_failures.append(name)
+
+    def merge(self, other):
+        self.files += other.files
+        self.bytes += other.bytes
+        self.seconds += other.seconds
+        self.encodings.update(other.encodings)
+        self.decode_failures += other.decode_failures
+
+    def to_dict(self):
+        return {'files': self.files, 'bytes': self.bytes, 'seconds': self.seconds,
+                'bytes_per_second': self.bytes_per_second(), 'encodings': dict(self.encodings),
+                'decode_failures': list(self.decode_failures)}
+
+
+def decode(data):
+    """
+    :param data: bytes-like
+    :return: tuple(text, encoding), encoding None if no candidate of ENCODINGS decodes it.
+    """
+    if data[:len(codecs.BOM_UTF8)] == codecs.BOM_UTF8:
+        try:
+            return str(data, 'utf-8-sig'), 'utf-8-sig'
+        except UnicodeDecodeError:
+            pass
+    for encoding in ENCODINGS:
+        try:
+            return str(data, encoding), encoding
+        except UnicodeDecodeError:
+            pass
+    return str(data, 'utf-8', 'replace'), None
+
+
+def read_text(path, stats=None, mmap_threshold=MMAP_THRESHOLD):
+    """read and decode one file, see decode. stats: ReadStats to update."""
+    start = time.perf_counter()
+    with open(path, 'rb') as f:
+        with _map(f, mmap_threshold) as data:
+            text, encoding = decode(data)
+            size = len(data)
+    if stats is not None:
+        stats.record(path, size, encoding, time.perf_counter() - start)
+    return text
+
+
+class _Bulk(object):
+    """file content read at once, same context manager interface as mmap."""
+
+    def __init__(self, f):
+        self.data = f.read()
+
+    def __enter__(self):
+        return self.data
+
+    def __exit__(self, *exc):
+        self.data = None
+        return False
+
+
+def _map(f, mmap_threshold):
+    size = os.fstat(f.fileno()).st_size
+    if size and mmap_threshold is not None and size >= mmap_threshold:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return _Bulk(f)
+
+
+def hidden(name):
+    return any(part.startswith('.') for part in name.split('/'))
+
+
+def selected(name, include, exclude):
+    """glob filters on the name; include None為全部。"""
+    if include and not any(fnmatch.fnmatch(name, pattern) for pattern in include):
+        return False
+    return not (exclude and any(fnmatch.fnmatch(name, pattern) for pattern in exclude))
+
+
+def scan_tree(path, recursive=True):
+    """:return: iterable of (relative path with '/', os.DirEntry), 用os.scandir，依名稱排序。"""
+    stack = [('', path)]
+    while stack:
+        prefix, directory = stack.pop()
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        subdirs = []
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                if recursive:
+                    subdirs.append((prefix + entry.name + '/', entry.path))
+            elif entry.is_file():
+                yield prefix + entry.name, entry
+        stack.extend(reversed(subdirs))
+
+
+def iter_zip(path, prefix='', wanted=None):
+    """:return: iterable of (member name, bytes). wanted(name) False的member不讀。"""
+    with zipfile.ZipFile(path) as archive:
+        for info in archive.infolist():
+            if not info.is_dir() and (wanted is None or wanted(prefix + info.filename)):
+                with archive.open(info) as f:
+                    yield prefix + info.filename, f.read()
+
+
+def iter_tar(path, prefix='', wanted=None):
+    """:return: iterable of (member name, bytes). 串流讀取，.gz/.xz/.bz2 不需要seek。wanted see iter_zip."""
+    with tarfile.open(path, 'r|*') as archive:
+        for member in archive:
+            if member.isfile() and (wanted is None or wanted(prefix + member.name)):
+                yield prefix + member.name, archive.extractfile(member).read()
+
+
+def iter_archive(path, prefix='', wanted=None):
+    if path.lower().endswith(ZIP_SUFFIXES):
+        return iter_zip(path, prefix, wanted)
+    return iter_tar(path, prefix, wanted)
+
+
+def parse_shard(value):
+    """'i/N' -> (i, N), 0 <= i < N."""
+    index, _, count = value.partition('/')
+    index, count = int(index), int(count)
+    if not 0 <= index < count:
+        raise ValueError('shard {} is not in 0/{} ~ {}/{}'.format(value, count, count - 1, count))
+    return index, count
+
+
+def in_shard(name, shard):
+    """stable across processes and machines (不用hash()，它每個process不同)。shard: (i, N)."""
+    index, count = shard
+    digest = hashlib.blake2b(name.encode('utf-8', 'surrogatepass'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % count == index
+
+
+def iter_bytes(path, include=None, exclude=None, recursive=True, mmap_threshold=MMAP_THRESHOLD,
+               shard=None, positions=None):
+    """
+    :param include, exclude: list of glob patterns matched against the name, e.g. ['*.txt'].
+    :param shard: (i, N), 只讀name hash到第i份的doc，see in_shard。
+    :param positions: list, 每讀一個doc append (它在不分shard時的順序, name)，合併shard時用。
+    :return: iterable of (name, bytes-like), None if path is neither a file nor a dir.
+        大檔案是mmap，只在取下一個之前有效。
+    """
+    if os.path.isdir(path):
+        files = scan_tree(path, recursive)
+    elif os.path.isfile(path):
+        files = [(os.path.basename(path), None)]
+    else:
+        return None
+    return _iter_bytes(path, files, _wanted(include, exclude, shard, positions), mmap_threshold)
+
+
+def _wanted(include, exclude, shard, positions):
+    """:return: function(name) -> bool, called once per candidate in order."""
+    counter = itertools.count()
+
+    def wanted(name):
+        if not selected(name, include, exclude):
+            return False
+        position = next(counter)
+        if shard is not None and not in_shard(name, shard):
+            return False
+        if positions is not None:
+            positions.append((position, name))
+        return True
+    return wanted
+
+
+def _iter_bytes(path, files, wanted, mmap_threshold):
+    for name, entry in files:
+        file_path = entry.path if entry is not None else path
+        if is_archive(name):
+            prefix = name + '/' if entry is not None else ''
+            for member, data in iter_archive(file_path, prefix, lambda member: not hidden(member) and wanted(member)):
+                yield member, data
+        elif wanted(name):
+            with open(file_path, 'rb') as f:
+                with _map(f, mmap_threshold) as data:
+                    yield name, data
+
+
+def iter_texts(path, include=None, exclude=None, recursive=True, stats=None, mmap_threshold=MMAP_THRESHOLD,
+               shard=None, positions=None):
+    """:return: iterable of (name, text), None if path is neither a file nor a dir. see iter_bytes, decode.
+    stats: ReadStats to update.
+    """
+    items = iter_bytes(path, include, exclude, recursive, mmap_threshold, shard, positions)
+    if items is None:
+        return None
+    return iter_decoded(items, stats)
+
+
+def iter_decoded(items, stats=None):
+    """(name, bytes-like) -> (name, text), see decode. stats: ReadStats to update."""
+    while True:
+        start = time.perf_counter()
+        try:
+            name, data = next(items)
+        except StopIteration:
+            return
+        text, encoding = decode(data)
+        if stats is not None:
+            stats.record(name, len(data), encoding, time.perf_counter() - start)
+        yield name, text
+
+
+_DONE = object()
+
+
+def prefetch(items, size=64):
+    """在背景thread讀取items，最多先讀size個。讀取時的exception在取到那個位置時raise。"""
+    buffer = queue.Queue(size)
+    stop = threading.Event()
+
+    def read():
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                buffer.put((item, None))
+            buffer.put((_DONE, None))
+        except BaseException as e:
+            buffer.put((_DONE, e))
+
+    thread = threading.Thread(target=read, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stop.set()
+        while thread.is_alive():  # 讓被put卡住的thread結束
+            try:
+                buffer.get_nowait()
+            except queue.Empty:
+                thread.join(0.01)
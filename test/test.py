@@ -1,6 +1,57 @@
+import contextlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import zipfile
 import unittest
 
 from tools import *
+from tools import _finditer_sentences
+import benchmark
+import cache
+import cellstore
+import extract_cells
+import extract_declared_sentence
+import memo
+import merge
+import penalty
+import metrics
+import resultstore
+import server
+import sources
+import watch
+
+
+SAMPLE_DOC = """臺灣臺北地方法院刑事判決
+被　　　告　王小明
+被　　　告　李大華
+上列被告因偽造文書案件，本院判決如下：
+    主 文
+王小明、李大華犯如附表所示之罪，各處如附表所示之刑。
+    犯罪事實及理由
+一、如附表所示。
+附表：
+┌─┬──────────────────┐
+│編號│主文                                │
+├─┼──────────────────┤
+│一│王小明共同犯行使偽造公文書罪，處有期徒刑壹年壹月；減為有│
+│  │期徒刑陸月又拾伍日。                │
+├─┼──────────────────┤
+│二│李大華共同犯行使偽造公文書罪，處有期徒刑壹年。│
+└─┴──────────────────┘
+以上正本證明與原本無異。
+"""
+# 李大華沒有宣告刑，結果為(charge, None)
+ACQUITTED_DOC = SAMPLE_DOC.replace('處有期徒刑壹年。│', '部分無罪。│')
 
 
 class TestFunctions(unittest.TestCase):
@@ -14,6 +65,28 @@ class TestFunctions(unittest.TestCase):
 
         self.assertEqual(list(extract_accuseds(data)), ['人 名○○'])
 
+    def test_locate_sections(self):
+        headings = locate_sections(SAMPLE_DOC)
+        spans = section_spans(SAMPLE_DOC, headings)
+
+        self.assertEqual(sorted(headings), ['abstract', 'ending', 'fact_reason'])
+        self.assertEqual(SAMPLE_DOC[slice(*headings['abstract'])], '\n    主 文\n')
+        self.assertTrue(SAMPLE_DOC[slice(*spans['fact_reason'])].startswith('\n    犯罪事實及理由\n一、'))
+        self.assertTrue(SAMPLE_DOC[slice(*spans['ending'])].startswith('\n以上正本證明與原本無異'))
+        self.assertEqual(spans['header'], (0, headings['abstract'][0]))
+
+    def test_extract_cells_per_table_in_sections(self):
+        self.assertEqual(list(extract_cells_per_table(SAMPLE_DOC, ['fact_reason'])),
+                         list(extract_cells_per_table(SAMPLE_DOC)))
+        self.assertEqual(list(extract_cells_per_table(SAMPLE_DOC, ['header', 'abstract', 'ending'])), [])
+        # 打錯的section名字不會變成每份doc都沒有表格
+        for parse_args, argv in ((extract_declared_sentence.parse_args, ['doc.txt']),
+                                 (extract_cells.parse_args, ['doc.txt']), (server.parse_args, ['--stdio'])):
+            with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+                parse_args(argv + ['--sections', 'fact_reasons'])
+        self.assertEqual(extract_cells.parse_args(['doc.txt', '--sections', 'fact_reason,ending']).sections,
+                         ['fact_reason', 'ending'])
+
     def test_extract_table_names(self):
         data = """
             主文
@@ -54,6 +127,94 @@ class TestFunctions(unittest.TestCase):
                                                                           ('Axx犯xx罪', None),
                                                                           ('Axxxxx，犯xx罪', None)])
 
+    def test_extract_sentences_per_accused(self):
+        cells = ['A犯xx罪，處有期徒刑x年x月。B犯yy罪，免刑；',
+                 'A、B、C均無罪。',
+                 'C犯zz罪，處有期徒刑x年，減為x月。',
+                 '人 名○○\n犯xx罪，累犯，處有期徒刑x年x月。']
+        accuseds = ['A', 'B', 'D', '人 名○○']
+
+        self.assertEqual(extract_sentences_per_accused(accuseds, cells),
+                         {accused: [pair for cell in cells for pair in extract_sentences(accused, cell)]
+                          for accused in accuseds})
+        self.assertEqual(extract_sentences_per_accused(accuseds, cells)['B'],
+                         [('B犯yy罪', '免刑；'), ('B、C均無罪', None)])
+
+    def test_scan_sentences(self):
+        texts = ['A犯xx罪，處有期徒刑x年，減為x月，緩刑x年。A犯yy罪部分無罪。',
+                 'xA，A犯xx罪、犯yy罪，處刑x月x',
+                 'A犯無罪犯xx罪；免刑x。A、A均無罪',
+                 'A' + '犯罪處刑' * 2000]
+        for text in texts[:-1]:
+            self.assertEqual(scan_sentences('A', text),
+                             list(_finditer_sentences(*compile_sentence_patterns('A'), text=text)))
+        self.assertEqual(scan_sentences('A', texts[-1]), [])  # regex會回溯很久
+
+    def test_scan_sentences_repeated_name(self):
+        # 名字重複出現在同一個run內，每次重掃會是平方時間
+        units = ['A', 'A犯', 'AB、', 'A無罪、', 'A，A犯']
+        for unit in units:
+            text = unit * 50 + '罪。處有期徒刑x年。'
+            self.assertEqual(scan_sentences('A', text),
+                             list(_finditer_sentences(*compile_sentence_patterns('A'), text=text)))
+        start = time.perf_counter()
+        for unit in units:
+            scan_sentences('A', unit * 20000 + '罪。處有期徒刑x年。')
+        self.assertLess(time.perf_counter() - start, 5)
+
+    def test_normalize(self):
+        self.assertEqual(extract_sentences('A', 'A犯xx罪,處有期徒刑１年，褫奪公權\r\n2年。'),
+                         [('A犯xx罪', '處有期徒刑1年，')])  # 沒有normalize_document
+        text = normalize_document('A犯xx罪，處有期徒刑１年，褫奪公權2年。')
+        self.assertEqual(extract_sentences('A', text), [('A犯xx罪', '處有期徒刑1年，禠奪公權2年。')])
+        self.assertEqual(display_width(text), display_width('A犯xx罪，處有期徒刑１年，褫奪公權2年。'))
+
+        cell = '王 小明犯\n竊盜罪，處拘役　１０日'
+        normalized, offsets = normalize_cell(cell), normalized_offsets(cell)
+        self.assertEqual(normalized, '王小明犯竊盜罪，處拘役　10日')
+        start = normalized.index('竊盜罪')
+        self.assertEqual(cell[slice(*source_span(offsets, start, start + 3))], '竊盜罪')
+        self.assertEqual(cell[slice(*source_span(offsets, 0, 4))], '王 小明犯')
+
+    def test_extract_sentence_spans(self):
+        cell = normalize_document('王 小明犯\n竊盜罪,處有期徒刑１年，褫奪公權\n2年。王小明、李四均無罪。')
+        pairs = extract_sentence_spans('王小明', cell)
+
+        self.assertEqual([(charge, sentence) for charge, sentence, _, _ in pairs],
+                         extract_sentences('王小明', cell))
+        self.assertEqual([(cell[slice(*charge)], sentence and cell[slice(*sentence)]) for _, _, charge, sentence in pairs],
+                         [('王小明、李四均無罪', None), ('王 小明犯\n竊盜罪', '處有期徒刑１年，禠奪公權\n2年。')])
+        # 名字含regex符號時用regex，位置相同
+        self.assertEqual(extract_sentence_spans('A.', 'A. 犯x罪，處刑1月。')[0][2:], ((0, 6), (7, 12)))
+
+    def test_budget(self):
+        cells = ['A犯xx罪，處有期徒刑x年。', 'A犯yy罪，處有期徒刑x月。' * 10]
+        budget = Budget(cell_chars=50).start()
+
+        self.assertEqual(extract_sentences_per_accused(['A'], cells, budget), {'A': [('A犯xx罪', '處有期徒刑x年。')]})
+        self.assertEqual(budget.skipped_cells, 1)
+        with self.assertRaises(BudgetExceededException):
+            extract_sentences_per_accused(['A'], cells, Budget(seconds=-1).start())
+
+    def test_decode_penalty(self):
+        nan = float('nan')
+        cases = [('處有期徒刑壹年壹月；減為有期徒刑陸月又拾伍日。', (3, 13, 6.5, nan, nan, nan)),
+                 ('處有期徒刑貳年，緩刑伍年。', (3, 24, nan, 60, nan, nan)),
+                 ('處拘役伍拾日，如易科罰金，以新臺幣壹仟元折算壹日。', (4, 50 / 30, nan, nan, nan, nan)),
+                 ('處死刑，褫奪公權終身。', (1, nan, nan, nan, float('inf'), nan)),
+                 ('處有期徒刑３年6月，禠奪公權參年，併科罰金新臺幣參萬伍仟元。', (3, 42, nan, nan, 36, 35000)),
+                 ('處罰金新臺幣五萬元。', (5, nan, nan, nan, nan, 50000)),
+                 ('處無期徒刑。', (2, nan, nan, nan, nan, nan)),
+                 ('處有期徒刑壹年又陸月。', (3, 18, nan, nan, nan, nan)),
+                 ('免刑。', (6, nan, nan, nan, nan, nan)),
+                 (None, (0, nan, nan, nan, nan, nan))]
+        for sentence, expected in cases:
+            self.assertEqual(repr(penalty.decode(sentence)), repr(penalty.Penalty(*map(float, expected))._replace(
+                penalty=expected[0])), sentence)
+        self.assertEqual([penalty.parse_number(n) for n in ('壹佰貳拾', '二十五', '兩萬零五十', '15')], [120, 25, 20050, 15])
+        self.assertEqual(penalty.charge_name('王小明共同犯行使偽造公文書罪', '王小明'), '行使偽造公文書罪')
+        self.assertEqual(penalty.court_of('dir/TPDM,109,訴,1,20200101,1.json'), 'TPDM')
+
     def test_extract_all_tables(self):
         data = \
             """
@@ -72,6 +233,21 @@ class TestFunctions(unittest.TestCase):
         self.assertEqual(list(extract_all_tables(data)),
                          ['┌─┬────\n└─┴───┘', '┌─┬──────┐\n│X│測試通過│\n├─┼──┼───┤\n└─┴──────┘'])
 
+    def test_locate_tables(self):
+        data = 'x┌─┐\n│┌┐│\n│└┘│\n└─┘y┘ ┌─┐\n└─┘ ┌──'
+
+        self.assertEqual(locate_tables(data), [(1, 18), (6, 13), (21, 28)])
+        self.assertEqual([data[s:e] for s, e in locate_tables(data)],
+                         list(extract_all_tables(data)))
+
+    def test_extract_rows_with_offsets(self):
+        table = '┌─┬─┐\n│1│a│\n├─┼─┤\n│2│b│\n└─┴─┘'
+        data = 'blabla\n' + table + '\nblabla'
+        (start, end), = locate_tables(data)
+
+        self.assertEqual(list(extract_rows(data, start, end)), list(extract_rows(table)))
+        self.assertEqual(list(extract_rows(table)), ['│1│a│', '│2│b│'])
+
     def test_extract_rows(self):
         data = \
             """
@@ -92,6 +268,21 @@ class TestFunctions(unittest.TestCase):
                           '│ 3│xxx│xxx│\n│  ├─────────┼──────┤\n│  │xxx │xxxx   │',
                           '│  │444│         │'])
 
+    def test_extract_rows_nested_table(self):
+        # cell內的表格之後還有rows，rows要到外面表格的'└'為止
+        nested = SAMPLE_DOC.replace('│編號│主文                                │\n',
+                                    '│編號│主文                                │\n'
+                                    '│  │┌────┐                    │\n'
+                                    '│  ││附件│                    │\n'
+                                    '│  │└────┘                    │\n')
+        start, end = locate_tables(nested)[0]
+
+        rows = list(extract_rows(nested, start, end))
+        self.assertEqual(len(rows), 3)
+        self.assertTrue(rows[2].startswith('│二│李大華'))
+        self.assertEqual(extract_declared_sentence.process_text(nested)[0],
+                         extract_declared_sentence.process_text(SAMPLE_DOC)[0])
+
     def test_parse(self):
         data = ['│1│ │    │',
                 '''
@@ -111,6 +302,20 @@ class TestFunctions(unittest.TestCase):
                            '如附表一編號14所示     ',
                            'A共同犯行使偽造公文書罪，處有期徒刑壹年。如附表二所示之偽造印文、署押，（含電池、SIM 卡），均沒收。           ']])
 
+    def test_parse_row_spanning_header(self):
+        data = ('│號碼│交易內容　　　　│總價│\n'
+                '│　　├──┬──┬──┤　　│\n'
+                '│　　│品名│單價│數量│　　│')
+
+        self.assertEqual(parse_row(data), ['號碼　　　　', '交易內容　　　　品名單價數量', '總價　　　　'])
+
+    def test_parse_table(self):
+        data = 'x\n┌─┬─┐\n│1│a│\n├─┼─┤\n│2│b│\n│ │c│\n└─┴─┘\n'
+        (start, end), = locate_tables(data)
+        grid = parse_table(data, start, end)
+
+        self.assertEqual(grid, Grid(['1', 'a', '2 ', 'bc'], [0, 2]))
+        self.assertEqual(grid.rows(), [['1', 'a'], ['2 ', 'bc']])
 
     def test_extract_cells_per_table(self):
         data = '''
@@ -142,7 +347,453 @@ blabla
                            '主文            ─────    宣告刑       ',
                            '一  ',
                            '郭美瑩共同犯行使偽造公文書罪，處有期徒刑壹年壹月；減為有期徒刑陸月又拾伍日。'],
-                             []])
+                          ['號碼         ', '交易內容    品名單價數量', '總價         ']])
+
+
+class TestMain(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for i in range(6):
+            with open(os.path.join(self.dir, 'doc{}.txt'.format(i)), 'w') as f:
+                f.write(SAMPLE_DOC if i % 3 else 'no accused here')
+        for key in extract_declared_sentence.count:
+            extract_declared_sentence.count[key] = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_main(self, **kwargs):
+        kwargs.setdefault('path', self.dir)
+        results = sorted(extract_declared_sentence.main(**kwargs))
+        count = dict(extract_declared_sentence.count)
+        for key in extract_declared_sentence.count:
+            extract_declared_sentence.count[key] = 0
+        return results, count
+
+    def test_main(self):
+        results, count = self.run_main()
+
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[0][1]['王小明'],
+                         [('王小明共同犯行使偽造公文書罪', '處有期徒刑壹年壹月；減為有期徒刑陸月又拾伍日。')])
+        self.assertEqual(count['doc'], 6)
+        self.assertEqual(count['prefilter_skipped_doc'], 2)
+        self.assertEqual(count['prefilter_skipped_cell'], 16)
+        self.assertEqual(count['output'], 4)
+
+    def test_main_no_prefilter(self):
+        results, count = self.run_main(prefilter=False)
+
+        self.assertEqual(results, self.run_main()[0])
+        self.assertEqual(count['doc'], 6)
+        self.assertEqual(count['accused_extraction_fail'], 2)
+        self.assertEqual((count['prefilter_skipped_doc'], count['prefilter_skipped_cell']), (0, 0))
+        self.assertEqual(count['output'], 4)
+
+    def test_main_workers(self):
+        self.assertEqual(self.run_main(workers=2, chunksize=2), self.run_main())
+        self.assertEqual(self.run_main(workers=2, ordered=False), self.run_main())
+
+    def test_main_cache(self):
+        cache_path = os.path.join(self.dir, '.cache.sqlite')
+        fresh = self.run_main()
+
+        self.assertEqual(self.run_main(cache_path=cache_path), fresh)
+        self.assertEqual(self.run_main(cache_path=cache_path), fresh)
+        self.assertEqual((cache.open_cache(cache_path).misses, cache.open_cache(cache_path).hits), (2, 10))
+        self.assertEqual(extract_cells.main(self.dir, cache_path=cache_path), extract_cells.main(self.dir))
+        cache.open_cache(cache_path).close()
+
+    def test_main_budget(self):
+        cache_path = os.path.join(self.dir, '.cache.sqlite')
+        results, count = self.run_main(cache_path=cache_path, doc_budget=-1)
+
+        self.assertEqual((results, count['budget_exceeded']), ([], 4))
+        self.assertEqual(self.run_main(cache_path=cache_path), self.run_main())
+        results, count = self.run_main(cell_budget=10)
+        self.assertEqual((results, count['cell_budget_exceeded']), ([], 8))
+        cache.open_cache(cache_path).close()
+
+    def test_archives(self):
+        archives = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archives)
+        names = sorted(os.listdir(self.dir))
+        with zipfile.ZipFile(os.path.join(archives, 'a.zip'), 'w') as archive:
+            for fn in names:
+                archive.write(os.path.join(self.dir, fn), 'zip/' + fn)
+        os.mkdir(os.path.join(archives, 'sub'))
+        with tarfile.open(os.path.join(archives, 'sub', 'b.tar.gz'), 'w:gz') as archive:
+            for fn in names:
+                archive.add(os.path.join(self.dir, fn), fn)
+        shutil.copy(os.path.join(self.dir, 'doc1.txt'), os.path.join(archives, 'sub', 'doc1.md'))
+
+        texts = dict(sources.iter_texts(archives, include=['*.txt']))
+        self.assertEqual(sorted(texts), sorted(['a.zip/zip/' + fn for fn in names] + ['sub/b.tar.gz/' + fn for fn in names]))
+        self.assertEqual(texts['sub/b.tar.gz/doc1.txt'], SAMPLE_DOC)
+        self.assertEqual(len(dict(sources.iter_texts(archives, exclude=['*.txt']))), 1)
+        self.assertEqual(len(dict(sources.iter_texts(archives, recursive=False))), 6)
+
+        results, count = self.run_main(path=os.path.join(archives, 'sub', 'b.tar.gz'), include=['*.txt'])
+        self.assertEqual([r[1] for r in results], [r[1] for r in self.run_main()[0]])
+        self.assertEqual(count['doc'], 6)
+
+    def test_encodings(self):
+        with open(os.path.join(self.dir, 'big5.txt'), 'wb') as f:
+            f.write(SAMPLE_DOC.encode('cp950'))
+        with open(os.path.join(self.dir, 'bom.txt'), 'wb') as f:
+            f.write(SAMPLE_DOC.encode('utf-8-sig'))
+        with open(os.path.join(self.dir, 'broken.txt'), 'wb') as f:
+            f.write(SAMPLE_DOC.encode('utf-8') + b'\xff\xfe\x80')
+
+        stats = sources.ReadStats()
+        texts = dict(sources.iter_texts(self.dir, stats=stats, mmap_threshold=1000))
+        self.assertEqual(texts['big5.txt'], SAMPLE_DOC)
+        self.assertEqual(texts['bom.txt'], SAMPLE_DOC)
+        self.assertEqual(sources.read_text(os.path.join(self.dir, 'big5.txt'), mmap_threshold=1), SAMPLE_DOC)
+        self.assertEqual(stats.encodings, {'utf-8': 6, 'cp950': 1, 'utf-8-sig': 1, None: 1})
+        self.assertEqual(stats.decode_failures, ['broken.txt'])
+
+        failures = []
+        results, count = self.run_main(on_failure=lambda *failure: failures.append(failure[1]))
+        self.assertEqual((len(results), count['decode_fail']), (7, 1))
+        self.assertEqual(count['read_bytes'], stats.bytes)
+        self.assertIn('broken.txt', failures)
+
+    def test_prefetch(self):
+        def items():
+            yield 1
+            yield 2
+            raise IOError('broken archive')
+
+        documents = sources.prefetch(items(), 1)
+        self.assertEqual([next(documents), next(documents)], [1, 2])
+        self.assertRaises(IOError, next, documents)
+        self.assertEqual(list(sources.prefetch(iter(range(100)), 3)), list(range(100)))
+
+    def test_memo(self):
+        memo.configure()
+        before = dict(extract_declared_sentence.memo_count)
+        memoized = self.run_main()
+        memo_count = {key: n - before[key] for key, n in extract_declared_sentence.memo_count.items()}
+
+        self.assertEqual(memo_count, {'table_memo_hit': 3, 'table_memo_miss': 1, 'cell_memo_hit': 6, 'cell_memo_miss': 2})
+        self.assertEqual(self.run_main(memo_sizes=(0, 0)), memoized)
+        self.assertEqual(self.run_main(workers=2, memo_sizes=(10, 10), memo_shared=True), memoized)
+        memo.configure()
+
+        lru = memo.LRU(2)
+        for key in 'abca':
+            if lru.get(key) is None:
+                lru.put(key, key.upper())
+        self.assertEqual((list(lru.data), lru.hits, lru.misses), (['c', 'a'], 0, 4))
+
+        # caller修改回傳的list不會改到memo內的結果
+        memo.configure()
+        expected = [list(cells) for cells in extract_cells_per_table(SAMPLE_DOC)]
+        for extract in (extract_cells_per_table, extract_declared_sentence.extract_cells_per_table):
+            cells_per_table = list(extract(SAMPLE_DOC))
+            cells_per_table[0].append('x')
+            cells_per_table[0][0] = 'y'
+            self.assertEqual(list(extract(SAMPLE_DOC)), expected)
+        pairs = memo.cell_matches('A', 'A犯xx罪。', sentence_matcher('A'))
+        pairs.append(None)
+        self.assertEqual(memo.cell_matches('A', 'A犯xx罪。', sentence_matcher('A')), [('A犯xx罪', None)])
+        memo.configure()
+
+    def test_shards(self):
+        os.mkdir(os.path.join(self.dir, 'sub'))
+        for i in range(6):
+            shutil.copy(os.path.join(self.dir, 'doc{}.txt'.format(i)), os.path.join(self.dir, 'sub'))
+        with open(os.path.join(self.dir, 'sub', 'broken.txt'), 'wb') as f:
+            f.write(SAMPLE_DOC.encode('utf-8') + b'\xff')
+        out = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, out)
+
+        def run(name, *args):
+            subprocess.check_call([sys.executable, 'extract_declared_sentence.py', self.dir, '--format', 'ndjson',
+                                   '--output', os.path.join(out, name), '--stats', os.path.join(out, name + '.stats'),
+                                   '--no-cache', '--no-prefilter', '--log', os.path.join(out, name + '.log')] + list(args),
+                                  cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        run('single')
+        names = ['{}.ndjson'.format(i) for i in range(3)]
+        for i, name in enumerate(names):
+            run(name, '--shard', '{}/3'.format(i))
+        merge.main([os.path.join(out, name) for name in names] +
+                   ['--shard-stats'] + [os.path.join(out, name + '.stats') for name in names] +
+                   ['--output', os.path.join(out, 'merged'), '--stats', os.path.join(out, 'merged.stats')])
+
+        with open(os.path.join(out, 'single'), encoding='utf-8') as a, \
+                open(os.path.join(out, 'merged'), encoding='utf-8') as b:
+            self.assertEqual(a.read(), b.read())
+        single = merge.read_ndjson(os.path.join(out, 'single.stats'))
+        merged = merge.read_ndjson(os.path.join(out, 'merged.stats'))
+        self.assertEqual(single[:-1], merged[:-1])
+        self.assertEqual(len(single), 6)
+        for summary in (single[-1], merged[-1]):
+            del summary['read']['seconds'], summary['read']['bytes_per_second'], summary['memo']
+        self.assertEqual(single[-1], merged[-1])
+        self.assertEqual(len(merged[-1]['read']['decode_failures']), 1)
+
+    def test_server(self):
+        documents = [(name, open(os.path.join(self.dir, name), encoding='utf-8').read())
+                     for name in sorted(os.listdir(self.dir))]
+        expected = json.loads(json.dumps(self.run_main()[0]))
+        service = server.Service(max_pending=2, cache_path=None, prefilter=False)
+        self.addCleanup(memo.configure)
+
+        out = io.StringIO()
+        lines = [json.dumps({'id': i, 'name': name, 'text': text}) for i, (name, text) in enumerate(documents)]
+        server.serve_lines(service, lines + ['[]', '{"id": "s", "stats": true}'], out)
+        responses = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(sorted(r['result'] for r in responses if r.get('result')), expected)
+        self.assertEqual(sorted(r['failures'][0]['failure'] for r in responses if r.get('failures')),
+                         ['doc0.txt', 'doc3.txt'])
+        self.assertEqual([r['id'] for r in responses if 'error' in r], [None])
+        self.assertIn('latency', next(r for r in responses if r['id'] == 's'))
+        stats = service.stats()
+        self.assertEqual((stats['count']['doc'], stats['requests']['count'], stats['requests']['pending']), (6, 6, 0))
+
+        service = server.Service(max_pending=2, cache_path=None)
+        http_server = server.make_http_server(service, port=0)
+        threading.Thread(target=http_server.serve_forever, daemon=True).start()
+        self.addCleanup(service.close)
+        self.addCleanup(http_server.server_close)
+        self.addCleanup(http_server.shutdown)
+        url = 'http://127.0.0.1:{}'.format(http_server.server_address[1])
+
+        def post(obj):
+            request = urllib.request.Request(url + '/extract', json.dumps(obj).encode('utf-8'), method='POST')
+            try:
+                with urllib.request.urlopen(request) as response:
+                    return response.status, json.load(response)
+            except urllib.error.HTTPError as e:
+                return e.code, json.load(e)
+
+        status, response = post({'name': documents[1][0], 'text': documents[1][1]})
+        self.assertEqual((status, response['result']), (200, expected[0]))
+        self.assertEqual(post({'name': 'x'})[0], 400)
+        for _ in range(2):
+            service.slots.acquire()
+        self.assertEqual(post({'name': 'x', 'text': 'x'})[0], 503)
+        for _ in range(2):
+            service.slots.release()
+        with urllib.request.urlopen(url + '/stats') as response:
+            stats = json.load(response)
+        self.assertEqual((stats['requests']['count'], stats['requests']['rejected']), (1, 1))
+        self.assertGreater(stats['latency']['p99'], 0)
+
+    def test_watch(self):
+        index = os.path.join(self.dir, '.watch.sqlite')
+        expected = self.run_main()[0]
+
+        def run(**kwargs):
+            kwargs.setdefault('polls', 1)
+            return watch.run(self.dir, lambda documents, stats: extract_declared_sentence.main(
+                documents=documents, stats=stats), index, interval=0, settle=0, **kwargs)
+
+        results = run()
+        self.assertEqual([next(results), next(results)], expected[:2])
+        results.close()  # 中斷後重新啟動，已取用下一筆(前一筆已寫出)的doc不重做
+        self.assertEqual(list(run()), expected[1:])
+        self.assertEqual(list(run()), [])
+
+        os.utime(os.path.join(self.dir, 'doc1.txt'))
+        with open(os.path.join(self.dir, 'doc2.txt'), 'a') as f:
+            f.write('\n')
+        shutil.copy(os.path.join(self.dir, 'doc4.txt'), os.path.join(self.dir, 'doc6.txt'))
+        self.assertEqual([name for name, _ in run()], ['doc2.txt', 'doc6.txt'])
+        self.assertEqual(list(run(polls=2)), [])
+        self.assertEqual(watch.Index(index, self.dir).load()['doc1.txt'][1],
+                         os.stat(os.path.join(self.dir, 'doc1.txt')).st_mtime_ns)
+
+        output = os.path.join(self.dir, '.out.ndjson')
+        for _ in range(2):
+            extract_declared_sentence.cli([self.dir, '--watch', '--watch-polls', '1', '--watch-settle', '0',
+                                           '--watch-index', os.path.join(self.dir, '.cli.sqlite'), '--no-cache',
+                                           '--format', 'ndjson', '--output', output, '--stats', os.devnull,
+                                           '--log', os.path.join(self.dir, '.log')])
+        memo.configure()
+        self.assertEqual(len(merge.read_ndjson(output)), 5)
+
+    def test_result_store(self):
+        path = os.path.join(self.dir, '.results.sqlite')
+        with open(os.path.join(self.dir, 'doc6.txt'), 'w') as f:
+            f.write(ACQUITTED_DOC)
+        results = self.run_main()[0]
+        self.assertEqual(results[-1][1]['李大華'], [('李大華共同犯行使偽造公文書罪', None)])
+        with resultstore.ResultStoreWriter(path, batch=3) as writer:
+            for result in results:
+                writer.add(result)
+            writer.add(['doc1.txt', {'張三': [('張三犯詐欺罪', '處有期徒刑陸月，緩刑貳年。'), ('張三犯竊盜罪', None)]}])
+
+        with resultstore.ResultStore(path) as store:
+            self.assertEqual(len(store), 5)
+            self.assertEqual(store.query(document='doc1.txt'),
+                             [{'document': 'doc1.txt', 'accused': '張三', 'charge': '張三犯詐欺罪',
+                               'sentence': '處有期徒刑陸月，緩刑貳年。'},
+                              {'document': 'doc1.txt', 'accused': '張三', 'charge': '張三犯竊盜罪', 'sentence': None}])
+            self.assertEqual(len(store.query(charge='偽造公文書罪')), 8)
+            self.assertEqual(store.query(charge='偽造', accused='王小明'), store.query(accused='王小明'))
+            self.assertEqual(len(store.query(charge='偽造', sentence='減為')), 4)
+            self.assertEqual(len(store.query(sentence='處')), 8)  # None的sentence不符合
+            self.assertEqual([row['document'] for row in store.query(charge='詐欺', sentence='緩刑')], ['doc1.txt'])
+            self.assertEqual(store.query(charge='偽造公文書罪', limit=1), store.query(charge='偽造', limit=1))
+            self.assertEqual(store.query(charge='100%_'), [])
+        count = subprocess.check_output([sys.executable, 'resultstore.py', 'query', path, '--sentence', '處', '--count'],
+                                        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(count.strip(), b'8')
+
+        for fmt in ('json', 'ndjson'):
+            output = os.path.join(self.dir, '.out.' + fmt)
+            extract_declared_sentence.cli([self.dir, '--format', fmt, '--output', output, '--no-cache',
+                                           '--sqlite', os.path.join(self.dir, '.cli.sqlite'),
+                                           '--log', os.path.join(self.dir, '.log')])
+            self.assertEqual(list(resultstore.read_results(output)), json.loads(json.dumps(results)))
+        memo.configure()
+        self.assertEqual(resultstore.load(path, [output]), 5)
+        with resultstore.ResultStore(os.path.join(self.dir, '.cli.sqlite')) as store, \
+                resultstore.ResultStore(path) as loaded:
+            self.assertEqual(len(store), 5)
+            self.assertEqual(store.query(), loaded.query())
+            self.assertEqual(store.query(document='doc6.txt')[-1]['sentence'], None)
+
+    @unittest.skipUnless(penalty.np, 'numpy is not installed')
+    def test_penalty_arrays(self):
+        path = os.path.join(self.dir, '.penalties.npz')
+        with open(os.path.join(self.dir, 'doc6.txt'), 'w') as f:
+            f.write(ACQUITTED_DOC)
+        output = os.path.join(self.dir, '.out.ndjson')
+        extract_declared_sentence.cli([self.dir, '--format', 'ndjson', '--output', output, '--no-cache',
+                                       '--penalties', path, '--log', os.path.join(self.dir, '.log')])
+        memo.configure()
+        arrays = penalty.load(path)
+        self.assertEqual(list(arrays['documents']), ['doc1.txt', 'doc2.txt', 'doc4.txt', 'doc5.txt', 'doc6.txt'])
+        self.assertEqual(sorted(arrays['charges']), ['行使偽造公文書罪'])
+        self.assertEqual(len(arrays['months']), 10)
+        self.assertEqual(arrays['penalty'][-1], 0)
+
+        converted = os.path.join(self.dir, '.converted.npz')
+        subprocess.check_call([sys.executable, 'penalty.py', 'arrays', converted, output], stdout=subprocess.DEVNULL,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        for key, values in penalty.load(converted).items():
+            self.assertEqual(repr(values.tolist()), repr(arrays[key].tolist()), key)  # nan != nan
+
+        summary = penalty.aggregate(arrays, 'accused', 'months', quantiles=(0.5, 1), bins=[12])
+        by_accused = dict(zip(summary['keys'], zip(summary['rows'], summary['count'], summary['quantiles'][1],
+                                                    summary['histogram'].tolist())))
+        self.assertEqual(by_accused, {'王小明': (5, 5, 13, [0, 5]), '李大華': (5, 4, 12, [0, 4])})
+        self.assertEqual(penalty.aggregate(arrays, 'charge', 'reduced_months')['mean'].tolist(), [6.5])
+        self.assertEqual(penalty.aggregate(arrays, 'court', 'penalty')['counts'].tolist(), [[1, 0, 0, 9, 0, 0, 0]])
+
+    def test_cache_eviction(self):
+        result_cache = cache.ResultCache(os.path.join(self.dir, '.cache.sqlite'), max_bytes=2000)
+        for i in range(20):
+            result_cache.put('test', str(i), 'x' * 200)
+
+        self.assertLessEqual(result_cache.total_bytes, 2000)
+        self.assertIsNone(result_cache.get('test', '0'))
+        self.assertEqual(result_cache.get('test', '19'), 'x' * 200)
+        result_cache.close()
+
+    def test_cell_store(self):
+        store_path = os.path.join(self.dir, '.cells')
+        extract_cells.write_store(store_path, self.dir)
+        with cellstore.CellStoreWriter(store_path) as writer:
+            writer.add_document('extra', [['a', 'b'], [], ['禠奪']])
+
+        with cellstore.CellStore(store_path) as store:
+            names = sorted(os.listdir(self.dir))
+            self.assertEqual(len(store), 7)
+            self.assertEqual(sorted(store.names()[:6]), [n for n in names if not n.startswith('.')])
+            self.assertEqual(list(store)[:6], extract_cells.main(self.dir))
+            self.assertEqual(store.tables(store.index('extra')), [['a', 'b'], [], ['禠奪']])
+            self.assertEqual(store[-1], ['a', 'b', '禠奪'])
+
+    def test_cli_ndjson(self):
+        output = os.path.join(self.dir, '.out.ndjson')
+        stats = os.path.join(self.dir, '.stats.ndjson')
+        extract_declared_sentence.cli([self.dir, '--format', 'ndjson', '--output', output, '--stats', stats, '--no-cache',
+                                   '--no-prefilter', '--memo-tables', '0', '--log', os.path.join(self.dir, '.log'),
+                                   '--metrics', os.path.join(self.dir, '.metrics.json')])
+        extract_declared_sentence.run_metrics.enabled = False
+        memo.configure()
+
+        with open(output, encoding='utf-8') as f:
+            records = [json.loads(line) for line in f]
+        with open(stats, encoding='utf-8') as f:
+            sidecar = [json.loads(line) for line in f]
+
+        self.assertEqual(len(records), 4)
+        self.assertEqual(sorted(r[0] for r in records), ['doc1.txt', 'doc2.txt', 'doc4.txt', 'doc5.txt'])
+        self.assertEqual(sorted(r['failure'] for r in sidecar[:-1]), ['doc0.txt', 'doc3.txt'])
+        self.assertEqual(sidecar[-1]['count']['doc'], 6)
+        with open(os.path.join(self.dir, '.metrics.json'), encoding='utf-8') as f:
+            summary = json.load(f)
+        self.assertEqual(summary['counters'], sidecar[-1]['count'])
+        self.assertEqual(summary['stages']['document']['count'], 6)
+        self.assertEqual(summary['stages']['parse']['count'], 4)
+        self.assertEqual(len(summary['slowest']), 6)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_merge(self):
+        a = metrics.Metrics(['doc'], slowest=2)
+        b = metrics.Metrics(['doc'], slowest=2)
+        for i in range(10):
+            (a if i % 2 else b).count({'doc': 1})
+            (a if i % 2 else b).observe_document(str(i), {'parse': 0.001 * i, 'document': 0.01 * i})
+        a.merge(metrics.Metrics.from_dict(json.loads(json.dumps(b.to_dict()))))
+
+        self.assertEqual(a.counters, {'doc': 10})
+        self.assertEqual(a.timings['parse'].count, 10)
+        self.assertAlmostEqual(a.timings['document'].total, 0.45)
+        self.assertEqual([name for _, name in a.slowest()], ['9', '8'])
+        self.assertLessEqual(a.timings['parse'].percentile(0.5), 0.005 * 2 ** 0.5)
+        self.assertAlmostEqual(a.timings['parse'].percentile(1), 0.009)
+
+    def test_disabled(self):
+        m = metrics.Metrics(['doc'], enabled=False)
+        m.observe_document('a', {'document': 1.0})
+        with metrics.Stopwatch(None)('parse'):
+            pass
+
+        self.assertEqual(m.timings, {})
+
+    def test_prometheus(self):
+        m = metrics.Metrics(['doc'])
+        m.count({'doc': 3})
+        m.observe_document('a', {'parse': 0.5})
+        text = m.to_prometheus()
+
+        self.assertIn('extract_declared_sentence_doc_total 3\n', text)
+        self.assertIn('extract_declared_sentence_stage_seconds_bucket{stage="parse",le="+Inf"} 1\n', text)
+        self.assertIn('extract_declared_sentence_stage_seconds_count{stage="parse"} 1\n', text)
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_generate_corpus(self):
+        corpus = benchmark.generate_corpus(docs=5, seed=1, nested=0.5, malformed=0.5)
+
+        self.assertEqual(corpus, benchmark.generate_corpus(docs=5, seed=1, nested=0.5, malformed=0.5))
+        for _, text in corpus:
+            self.assertEqual(len(list(extract_accuseds(text))), 2)
+            self.assertGreaterEqual(len(locate_tables(text)), 1)
+
+    def test_run(self):
+        results = benchmark.run(benchmark.generate_corpus(docs=3), repeat=1, memory=False)
+
+        self.assertEqual(list(results), [name for name, _ in benchmark._stages()])
+        self.assertGreater(results['parse']['cells/s'], 0)
+
+    def test_run_memo(self):
+        tables = memo.tables
+        corpus = benchmark.generate_corpus(docs=3)
+        results = benchmark.run(corpus + corpus, repeat=2, memory=False, stages=['end_to_end', 'end_to_end_memo'])
+
+        self.assertEqual(set(results['end_to_end']['memo'].values()), {0})  # repeat之間不會hit
+        memo_stats = results['end_to_end_memo']['memo']
+        self.assertEqual(memo_stats['table_memo_hit'], memo_stats['table_memo_miss'])  # 第二份corpus才hit
+        self.assertIs(memo.tables, tables)
 
 
 if __name__ == '__main__':
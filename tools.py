@@ -1,16 +1,26 @@
 import os
 import re
 import logging
+import functools
+import bisect
+import collections
+import time
+import unicodedata
 
 import pprint
 import itertools
 import sys
 
+import memo
+
 pprint = pprint.pprint
 
 log = logging.getLogger(__name__)
 # log.setLevel(logging.INFO)
 
+# 抽取結果有變時要加一，舊的cache就不會再被使用。see cache.py
+EXTRACTOR_VERSION = 6
+
 # pattern : no other words in same line
 abstract_heading_pattern = r'\n\W*主\s*文\W*\n'
 fact_heading_pattern = r'\n\W*事\s*實\W*\n'
@@ -19,13 +29,135 @@ fact_reason_heading_pattern = r'\n\W*犯罪事實及理由\W*\n'
 section_heading_pattern = r'\n\s{4}[\w\s]{2,10}\n'
 essay_ending_pattern = r'\W*以上正本證明與原本無異\W*\n'
 
+verbose_whitespace_regex = re.compile(r'[ \t\n\r\v\f]')  # re.VERBOSE忽略的空白
+word_run_regex = re.compile(r'\w*')
+charge_run_regex = re.compile(r'[\w、（）\(\)]*')
+not_charge_run_regex = re.compile(r'[\w、]*')
+nonword_regex = re.compile(r'\W')
+last_nonword_regex = re.compile(r'\W\w*\Z')
+box_corner_regex = re.compile(r'[┌┘]')
+separator_regex = re.compile(r'[│├┤┼]')
+rule_regex = re.compile(r'[\s─━═┬┴]*[─━═┬┴][\s─━═┬┴]*')  # cell內的橫線
+dividing_line_regex = re.compile(r'''
+    \n├       #左邊界，需要\n知道換行，因為這裡不是一行一行找的
+    [┼┴┬─]+   #中間都是框架符號，不能有字
+    ┤\s*?\n    #右邊界
+    ''', re.VERBOSE)
+
+
+# 一次掃過全文用。在每個換行試所有標題，lookahead不吃掉字，相鄰的標題不會互相擋住。
+# 每個標題第一次出現的位置和單獨對該pattern做re.search相同。
+section_heading_regex = re.compile(
+    r'(?=(?P<abstract>{})|(?P<fact>{})|(?P<reason>{})|(?P<fact_reason>{})|(?P<ending>\n{}))\n'.format(
+        abstract_heading_pattern, fact_heading_pattern, reason_heading_pattern,
+        fact_reason_heading_pattern, essay_ending_pattern))
+accused_regex = re.compile(r"""
+    被\s*告\W+     #被告兩字
+    ([\w○\t ]{2,})  #人名公司名,包含mask'○' and space
+    \W         #後面不接字
+    """, re.VERBOSE)
+
+word_regex = re.compile(r'\w')
+
+SECTIONS = ('header', 'abstract', 'fact', 'reason', 'fact_reason', 'ending')
+
 
 class PatternNotFoundException(Exception):
     """"""
     pass
 
 
-def extract_accuseds(fulltext):
+class BudgetExceededException(Exception):
+    """document took longer than its Budget"""
+    pass
+
+
+class Budget(object):
+    """
+    一份doc的處理上限，None為不限制。
+    seconds: 整份doc的秒數，超過時 check() raise BudgetExceededException。
+    cell_chars: 單一cell的字數，超過的cell不抽取，記在 skipped_cells。
+
+    budget = Budget(seconds=2, cell_chars=5000).start()
+    """
+
+    def __init__(self, seconds=None, cell_chars=None):
+        self.seconds = seconds
+        self.cell_chars = cell_chars
+        self.deadline = None
+        self.skipped_cells = 0
+
+    def start(self):
+        self.deadline = time.perf_counter() + self.seconds if self.seconds is not None else None
+        self.skipped_cells = 0
+        return self
+
+    def check(self):
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            raise BudgetExceededException('document budget of {}s exceeded'.format(self.seconds))
+
+    def allows(self, cell):
+        """check the deadline. :return: False if the cell is too long to extract."""
+        self.check()
+        if self.cell_chars is not None and len(cell) > self.cell_chars:
+            self.skipped_cells += 1
+            return False
+        return True
+
+
+def locate_sections(fulltext):
+    """一次掃過全文，找出 主文、事實、理由、犯罪事實及理由 標題和 以上正本證明與原本無異 結尾。
+    每種標題只取第一次出現的。
+
+    :return: dict of section name -> (heading start, heading end), 沒找到的section沒有key.
+        section name see SECTIONS; 'header' 不是標題，是開頭到第一個標題。
+    """
+    headings = {}
+    for m in section_heading_regex.finditer(fulltext):
+        name = m.lastgroup
+        if name not in headings:
+            headings[name] = (m.start(name), m.end(name))
+            if len(headings) == len(SECTIONS) - 1:
+                break
+
+    return headings
+
+
+def section_spans(fulltext, headings=None):
+    """每個section從標題開始到下一個標題之前；'ending' 到全文結束(附表常在結尾之後)。
+    :return: dict of section name -> (start, end)
+    """
+    if headings is None:
+        headings = locate_sections(fulltext)
+
+    starts = sorted((_line_start(fulltext, start), name) for name, (start, _) in headings.items())
+    spans = {'header': (0, starts[0][0] if starts else len(fulltext))}
+    for (start, name), (end, _) in zip(starts, starts[1:] + [(len(fulltext), None)]):
+        spans[name] = (start, end)
+    return spans
+
+
+def _line_start(fulltext, heading_start):
+    r"""標題pattern前面的\W*可能吃到上一個表格的底線，section從標題字那一行開始。"""
+    m = word_regex.search(fulltext, heading_start)
+    if m is None:
+        return heading_start
+    return max(heading_start, fulltext.rfind('\n', heading_start, m.start()))
+
+
+def section_ranges(fulltext, sections, headings=None):
+    """指定sections的(start, end)，排序並合併相連的範圍。"""
+    spans = section_spans(fulltext, headings)
+    ranges = []
+    for start, end in sorted(spans[name] for name in sections if name in spans):
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(end, ranges[-1][1]))
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+def extract_accuseds(fulltext, headings=None):
     """
     被告名稱抓取.
     多人CASE如下沒有考慮：
@@ -33,31 +165,33 @@ def extract_accuseds(fulltext):
         人名
        共兩人
 
+    :param headings: locate_sections(fulltext)的結果，已經算過可以直接給。
     :return: iterable of name string
     """
-
-    p = r"""
-    被\s*告\W+     #被告兩字
-    ([\w○\t ]{2,})  #人名公司名,包含mask'○' and space
-    \W         #後面不接字
-    """
+    if headings is None:
+        headings = locate_sections(fulltext)
 
     # locate 主文之前
-    start = 0
-    end = re.search(abstract_heading_pattern, fulltext).end()
-    text = fulltext[start:end]
+    if 'abstract' not in headings:
+        raise PatternNotFoundException('主文 heading not found.')
+    end = headings['abstract'][1]
 
-    matches = re.finditer(p, text, re.VERBOSE)
+    matches = accused_regex.finditer(fulltext, 0, end)
     return (m.group(1) for m in matches)
 
 
-def extract_table_names(fulltext):
+def extract_table_names(fulltext, headings=None):
     """"""
+    if headings is None:
+        headings = locate_sections(fulltext)
+
     # locate 主文~事實
-    start = re.search(abstract_heading_pattern, fulltext).start()
     # 主文之後的section標題不太一定(eg. 犯罪事實及理由)
-    p = '|'.join([fact_heading_pattern, reason_heading_pattern, fact_reason_heading_pattern])
-    end = re.search(p, fulltext).end()
+    ends = [headings[name] for name in ('fact', 'reason', 'fact_reason') if name in headings]
+    if 'abstract' not in headings or not ends:
+        raise PatternNotFoundException('主文 or 事實/理由 heading not found.')
+    start = headings['abstract'][0]
+    end = min(ends)[1]
 
     # 提到的附表全包下，非常不精確，有很多提到的附表是跟判刑無關。
     text = re.sub('\n', '', fulltext[start:end])
@@ -67,14 +201,361 @@ def extract_table_names(fulltext):
 
 def extract_sentences(accused, text):
     """抓罪名和判刑charge+sentence，使用很限制的pattern，charge之後標點符號直接接sentence。
-    囧....'禠'!='褫'，同一個字文本內的和自己打的不相等。無法理解？
+    囧....'禠'!='褫'，同一個字文本內的和自己打的不相等。process_text先用normalize_document統一。
     失敗case：
     A犯xx罪，xx罪。
     A,B,C 均無罪。
     A犯XX罪，.....，又因..犯..罪，...，又...
+    pattern see compile_sentence_patterns, 實際用 scan_sentences 掃。
 
     :return: iterable of tuple(charge, declared sentence) of accused
     """
+    return sentence_matcher(accused)(normalize_cell(text))
+
+
+def extract_sentence_spans(accused, cell):
+    """同 extract_sentences，另外給每個pair在原cell(normalize_cell之前)的位置。
+    normalize_document長度不變，cell先normalize_document過的話位置和原文的cell相同。
+
+    :return: list of tuple(charge, declared sentence, charge span, sentence span or None)，span為(start, end) in cell
+    """
+    normalized = normalize_cell(cell)
+    offsets = normalized_offsets(cell)
+    return [(normalized[slice(*charge)], normalized[slice(*sentence)] if sentence else None,
+             source_span(offsets, *charge), source_span(offsets, *sentence) if sentence else None)
+            for charge, sentence in sentence_span_matcher(accused)(normalized)]
+
+
+# 異體字：文本內的換成pattern用的字
+VARIANTS = {'褫': '禠', '爲': '為', '减': '減'}
+
+
+def _document_table():
+    table = {ord(variant): char for variant, char in VARIANTS.items()}
+    # Big5轉出來的CJK相容表意字換成統一表意字
+    for code in range(0xF900, 0xFB00):
+        char = unicodedata.normalize('NFKC', chr(code))
+        if len(char) == 1 and char != chr(code):
+            table[code] = char
+    return table
+
+
+# 一字換一字且寬度不變，表格對齊和offset都不受影響
+DOCUMENT_TABLE = _document_table()
+
+# cell內：刪除空白，全形英數字換半形，半形逗號分號換全形
+CELL_TABLE = dict.fromkeys(map(ord, '\n\t\r '))
+CELL_TABLE.update({code: code - 0xFEE0 for code in range(ord('０'), ord('９') + 1)})
+CELL_TABLE.update({code: code - 0xFEE0 for code in range(ord('Ａ'), ord('Ｚ') + 1)})
+CELL_TABLE.update({code: code - 0xFEE0 for code in range(ord('ａ'), ord('ｚ') + 1)})
+CELL_TABLE.update({ord(','): '，', ord(';'): '；'})
+
+cell_whitespace_regex = re.compile(r'[\n\t\r ]')
+cell_kept_regex = re.compile(r'[^\n\t\r ]')
+# 中文字多的字串str.translate很慢，先用regex確認有要換的字
+document_table_regex = re.compile('[{}]'.format(''.join(re.escape(chr(code)) for code in DOCUMENT_TABLE)))
+cell_table_regex = re.compile('[{}]'.format(''.join(re.escape(chr(code)) for code, char in CELL_TABLE.items()
+                                                     if char is not None)))
+
+
+def normalize_document(text):
+    """整份doc一次：異體字和相容表意字，見DOCUMENT_TABLE。長度不變，offset和原文相同。"""
+    if document_table_regex.search(text) is None:
+        return text
+    return text.translate(DOCUMENT_TABLE)
+
+
+def normalize_cell(cell):
+    """cell去空白並統一全形半形，見CELL_TABLE。sentence pattern掃的是這個結果。"""
+    cell = cell_whitespace_regex.sub('', cell)
+    if cell_table_regex.search(cell) is None:
+        return cell
+    return cell.translate(CELL_TABLE)
+
+
+def normalized_offsets(cell):
+    """:return: list, normalize_cell(cell)[i] 是 cell[offsets[i]] 來的(normalize_cell只刪字和一字換一字)。"""
+    return [m.start() for m in cell_kept_regex.finditer(cell)]
+
+
+def source_span(offsets, start, end):
+    """span of normalize_cell(cell)[start:end] in the original cell, see normalized_offsets."""
+    return offsets[start], offsets[end - 1] + 1
+
+
+# 有結果的doc一定有表格、主文標題和罪字
+PREFILTER_KEYWORDS = ('┌', '主', '罪')
+
+
+def prefilter_document(text, keywords=PREFILTER_KEYWORDS):
+    """便宜的substring檢查，False的doc不可能抽到宣告刑，不用跑regex。"""
+    return all(keyword in text for keyword in keywords)
+
+
+def prefilter_cells(accuseds, cells, normalized=False):
+    """留下可能有charge的cell：有'罪'字且有某個被告的名字。
+    名字含regex符號時只檢查'罪'字。
+    normalized: cells已經過normalize_cell。
+
+    :return: list of normalized cells
+    """
+    if not normalized:
+        cells = [normalize_cell(cell) for cell in cells]
+    literals = [_name_literal(accused) for accused in accuseds]
+    if None in literals:
+        return [cell for cell in cells if '罪' in cell]
+    return [cell for cell in cells if '罪' in cell and any(literal in cell for literal in literals)]
+
+
+def extract_sentences_per_accused(accuseds, cells, budget=None, normalized=False):
+    """同時抓所有被告的charge+sentence。
+    每個被告的matcher只準備一次，每個cell只normalize一次(normalized=True時已做過)，
+    cell內沒有被告名字就不掃，掃過的同內容cell用memo的結果(see memo.py)。
+    結果等同對每個被告把 extract_sentences(accused, cell) 逐cell串接。
+    :param budget: Budget, 超過時間raise BudgetExceededException，太長的cell跳過。
+
+    :return: dict of accused -> list of tuple(charge, declared sentence)
+    """
+    matchers = [(accused, _name_literal(accused) or '', sentence_matcher(accused)) for accused in accuseds]
+
+    charge_sentence_pairs = {accused: [] for accused, _, _ in matchers}
+    for cell in cells:
+        if budget is not None and not budget.allows(cell):
+            continue
+        if not normalized:
+            cell = normalize_cell(cell)
+        for accused, literal, matcher in matchers:
+            if literal not in cell:
+                continue
+            charge_sentence_pairs[accused] += memo.cell_matches(accused, cell, matcher)
+
+    return charge_sentence_pairs
+
+
+def _name_literal(accused):
+    """名字在normalize過的cell內和VERBOSE pattern內的樣子(空白被忽略)；含regex符號或空的名字return None."""
+    literal = verbose_whitespace_regex.sub('', normalize_cell(accused))
+    if not literal or re.escape(literal) != literal:
+        return None
+    return literal
+
+
+@functools.lru_cache(maxsize=1024)
+def sentence_matcher(accused):
+    """:return: function(normalized cell, see normalize_cell) -> list of tuple(charge, declared sentence).
+    普通名字用scan_sentences，名字含regex符號時用compile_sentence_patterns的regex.
+    """
+    literal = _name_literal(accused)
+    if literal is not None:
+        return functools.partial(scan_sentences, literal)
+    patterns = compile_sentence_patterns(normalize_cell(accused))
+    return lambda text: list(_finditer_sentences(*patterns, text=text))
+
+
+@functools.lru_cache(maxsize=1024)
+def sentence_span_matcher(accused):
+    """同 sentence_matcher，但 :return: function(normalized cell) -> list of tuple(charge span, sentence span or None)."""
+    literal = _name_literal(accused)
+    if literal is not None:
+        return functools.partial(scan_sentence_spans, literal)
+    patterns = compile_sentence_patterns(normalize_cell(accused))
+    return lambda text: list(_finditer_sentence_spans(*patterns, text=text))
+
+
+def scan_sentences(name, text):
+    """scan_sentence_spans的結果切成字串。
+
+    :return: list of tuple(charge, declared sentence)
+    """
+    return [(text[slice(*charge)], text[slice(*sentence)] if sentence else None)
+            for charge, sentence in scan_sentence_spans(name, text)]
+
+
+def scan_sentence_spans(name, text):
+    r"""
+    結果和compile_sentence_patterns的regex完全相同，但不靠regex回溯：
+    那些pattern的多個\w*疊在一起，沒有標點的長句子會回溯很久。
+    這裡依pattern的greedy順序直接找位置，同一個run(\w*等)內名字出現多次時共用一次掃描的結果(see _Runs)，
+    時間和text長度成正比。text要先normalize_cell。
+
+    :return: list of tuple(charge span, sentence span or None), span為(start, end) in text
+    """
+    last_nonword = _last_nonword(text)
+    match_not_charge = functools.partial(_match_not_charge, runs=_Runs(text, not_charge_run_regex))
+    match_charge = functools.partial(_match_charge, words=_Runs(text, word_run_regex),
+                                     charges=_Runs(text, charge_run_regex),
+                                     second_charges=_Runs(text, charge_run_regex))
+    return (list(_scan_name(name, text, match_not_charge, last_nonword)) +
+            list(_scan_name(name, text, match_charge, last_nonword)))
+
+
+class _Runs(object):
+    """
+    text內某個run regex(\\w*等)最近一次match的範圍，和由run開頭算出的結果(data)。
+    pos在run內時run結束的位置都一樣，由run開頭算的rfind結果只要再比較是否在pos之後，不用重掃。
+    """
+
+    def __init__(self, text, regex):
+        self.text = text
+        self.regex = regex
+        self.start = self.end = -1
+        self.data = {}
+
+    def end_at(self, pos):
+        """:return: end of the run matched at pos, pos在上一個run內時不重掃。"""
+        if not self.start <= pos <= self.end:
+            self.start = pos
+            self.end = self.regex.match(self.text, pos).end()
+            self.data = {}
+        return self.end
+
+
+def _last_nonword(text):
+    r"""index of the last \W char, 0 if none (a match can never end at 0)."""
+    m = last_nonword_regex.search(text)
+    return m.start() if m else 0
+
+
+def _scan_name(name, text, match, last_nonword):
+    """like re.finditer: match at each occurrence of name, matches do not overlap."""
+    pos = 0
+    while True:
+        p = text.find(name, pos)
+        if p == -1:
+            return
+        m = match(text, p, p + len(name), last_nonword)
+        if m is None:
+            pos = p + 1
+        else:
+            charge, sentence, pos = m
+            yield charge, sentence
+
+
+def _match_not_charge(text, p, q, last_nonword, runs):
+    r"""({name}[\w、]*無罪\w*)\W at p; name ends at q.
+    [\w、]*greedy: 最後面的'無罪'優先，後面的\w*之後要有\W，也就是'無罪'之後還有\W字。
+    :param runs: _Runs of not_charge_run_regex
+    :return: tuple(charge span, None, match end) or None
+    """
+    run_end = runs.end_at(q)
+    if 'i' not in runs.data:
+        runs.data['i'] = text.rfind('無罪', runs.start, min(run_end, last_nonword))
+    i = runs.data['i']
+    if i < q:
+        return None
+    word_end = word_run_regex.match(text, i + 2).end()
+    return (p, word_end), None, word_end + 1
+
+
+def _match_charge(text, p, q, last_nonword, words, charges, second_charges):
+    r"""charge_pattern + (sentence_pattern|not_sentence_pattern)? at p; name ends at q.
+    \w*，?\w*犯 greedy: 有逗號時先試逗號後面的'犯'，再試前面的，各自由後往前。
+    :param words: _Runs of word_run_regex; charges, second_charges: _Runs of charge_run_regex
+    :return: tuple(charge span, sentence span or None, match end) or None
+    """
+    first_end = words.end_at(q)
+    data = words.data
+    if not data:
+        # 逗號後面的部分和q無關；前面的部分由run開頭算，再和q比較
+        data['second'] = None
+        if text.startswith('，', first_end):
+            start = first_end + 1
+            e, k = _crime(text, start, word_run_regex.match(text, start).end(), second_charges)
+            if k != -1:
+                data['second'] = e + 1
+        data['first'] = _crime(text, words.start, first_end, charges)
+
+    crime_end = data['second']
+    if crime_end is None:
+        e, k = data['first']
+        if e < q + 2 or k < q:
+            return None
+        crime_end = e + 1
+    sentence, match_end = _match_sentence(text, crime_end + 1)
+    return (p, crime_end), sentence, match_end
+
+
+def _crime(text, start, end, charges):
+    r"""犯 in text[start:end] followed by [\w、（）\(\)]*[^無]罪\W.
+    '罪'越後面越優先，配到它的'犯'是它前面最後一個'犯'.
+    text[start:end]都是\w，'犯'之後的[\w、（）\(\)]*都到同一個地方，所以由start之後的s開始時
+    '罪'相同(e >= s + 2時)，'犯'是k(k >= s時)。
+    :param charges: _Runs of charge_run_regex
+    :return: tuple(e, k), index of '罪' and '犯', -1 if none
+    """
+    if start == end:
+        return -1, -1
+    run_end = charges.end_at(start)
+    if 'e' not in charges.data:
+        charges.data['e'] = _last_crime(text, charges.start, run_end)
+    e = charges.data['e']
+    if e < start + 2:
+        return -1, -1
+    return e, text.rfind('犯', start, min(end, e - 1))
+
+
+def _last_crime(text, start, run_end):
+    r"""last '罪' in text[start + 2:run_end + 2] following [^無] and followed by \W, -1 if none."""
+    e = text.rfind('罪', start + 2, run_end + 2)
+    while e != -1:
+        if text[e - 1] != '無' and nonword_regex.match(text, e + 1):
+            return e
+        e = text.rfind('罪', start + 2, e)
+    return -1
+
+
+def _match_sentence(text, s):
+    """(sentence_pattern|not_sentence_pattern)? at s.
+    :return: tuple(sentence span or None, match end)
+    """
+    first_end = word_run_regex.match(text, s).end()
+    end = None
+    # \w*[，]{0,1}\w*處\w*刑\w*[年月]\w*\W 的\w*最後一定吃到下一個\W，先試有逗號的
+    if text.startswith('，', first_end):
+        second_end = word_run_regex.match(text, first_end + 1).end()
+        if second_end < len(text) and _has_penalty(text, first_end + 1, second_end):
+            end = second_end + 1
+    if end is None and first_end < len(text) and _has_penalty(text, s, first_end):
+        end = first_end + 1
+
+    if end is None:
+        if text.startswith('免刑', s) and first_end < len(text):
+            return (s, first_end + 1), first_end + 1
+        return None, s
+
+    # 減為, 緩刑, 禠奪公權 句子，每句到下一個\W為止
+    while True:
+        clause_end = word_run_regex.match(text, end).end()
+        if clause_end >= len(text) or not _is_optional_clause(text, end, clause_end):
+            break
+        end = clause_end + 1
+    return (s, end), end
+
+
+def _has_penalty(text, start, end):
+    """處...刑...[年月] in text[start:end]"""
+    i = text.find('處', start, end)
+    if i == -1:
+        return False
+    j = text.find('刑', i + 1, end)
+    if j == -1:
+        return False
+    return text.find('年', j + 1, end) != -1 or text.find('月', j + 1, end) != -1
+
+
+def _is_optional_clause(text, start, end):
+    """減為...[年月] or 緩刑... or ...禠奪公權... is text[start:end]"""
+    i = text.find('減為', start, end)
+    if i != -1 and (text.find('年', i + 2, end) != -1 or text.find('月', i + 2, end) != -1):
+        return True
+    return text.startswith('緩刑', start, end) or text.find('禠奪公權', start, end) != -1
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_sentence_patterns(accused):
+    """compile某被告的無罪pattern和charge+sentence pattern.
+    :return: tuple(not_charge regex, charge_sentence regex)
+    """
     not_charge_pattern = r'''
     ({0}                #某某某
     [\w、]*無罪\w*)        #接無罪句子允許頓號
@@ -101,35 +582,64 @@ def extract_sentences(accused, text):
     '''
     not_sentence_pattern = r'''(免刑\w*\W)'''
 
-    text = re.sub(r'[\n\t ]', '', text)
-    ms1 = re.finditer(not_charge_pattern, text, re.VERBOSE)
-    not_charges = ((m.group(1), None) for m in ms1)
-
     # 加一個?允許可以沒有sentence。就是允許沒找到，可能是pattern不符。
-    ms2 = re.finditer(charge_pattern + '(' + sentence_pattern + '|' + not_sentence_pattern + ')?', text, re.VERBOSE)
-    charge_sentence_pairs = ((m.group(1), m.group(2)) for m in ms2)
+    return (re.compile(not_charge_pattern, re.VERBOSE),
+            re.compile(charge_pattern + '(' + sentence_pattern + '|' + not_sentence_pattern + ')?', re.VERBOSE))
+
+
+def _finditer_sentences(not_charge_regex, charge_sentence_regex, text):
+    """run the compile_sentence_patterns regexes."""
+    not_charges = ((m.group(1), None) for m in not_charge_regex.finditer(text))
+    charge_sentence_pairs = ((m.group(1), m.group(2)) for m in charge_sentence_regex.finditer(text))
 
     return itertools.chain(not_charges, charge_sentence_pairs)  # not_charge和charge是exclusive pattern
 
 
+def _finditer_sentence_spans(not_charge_regex, charge_sentence_regex, text):
+    """同 _finditer_sentences，:return: tuple(charge span, sentence span or None)."""
+    not_charges = ((m.span(1), None) for m in not_charge_regex.finditer(text))
+    charge_sentence_pairs = ((m.span(1), m.span(2) if m.group(2) is not None else None)
+                             for m in charge_sentence_regex.finditer(text))
+    return itertools.chain(not_charges, charge_sentence_pairs)
+
+
+def locate_tables(text, start=0, end=None):
+    """一次掃過全文，找出所有 '┌' 到對應 '┘' 的表格位置。
+    用stack配對，表格內有表格時內外表格各自配到自己的 '┘'。
+    沒有 '┘' 的 '┌' (unterminated) 和多出來的 '┘' 會被略過並記log.
+    有start,end時只找 '┌' 在text[start:end]內的表格，'┘' 可以超出end。
+
+    :return: list of (start, end) offsets in text, sorted by start.
+    """
+    if end is None:
+        end = len(text)
+
+    tops = []
+    tables = []
+    for m in box_corner_regex.finditer(text, start):
+        if m.start() >= end and not tops:
+            break
+        if m.group() == '┌':
+            if m.start() >= end:
+                continue
+            tops.append(m.start())
+        elif tops:
+            tables.append((tops.pop(), m.end()))
+        else:
+            log.debug('unmatched table bottom at {}'.format(m.start()))
+
+    for top in tops:
+        log.debug('unterminated table at {}: {}...'.format(top, text[top:top + 15]))
+
+    tables.sort()
+    return tables
+
+
 def extract_all_tables(text):
     """extract all table that has boundary '┌' and '┘'.
     :return:  iterable of table strings.
     """
-    tops = re.finditer(r'┌', text)
-    bottom_of = lambda top: re.search(r'┘', text[top.start():])
-    tables = ( (top, bottom_of(top)) for top in tops )
-
-    for top, bottom in tables:
-        try:
-            yield text[top.start():top.start() + bottom.end()]
-        except Exception as e: #mainly AttributeError  that top or end is None
-            log.debug('{}'.format(e))
-            #skip !!
-            continue
-
-    # return (text[top.start():top.start() + bottom.end()]
-    #         for top, bottom in tables)
+    return (text[start:end] for start, end in locate_tables(text))
 
 
 def slide2(iterable):
@@ -139,29 +649,28 @@ def slide2(iterable):
     return zip(a, b)
 
 
-def extract_rows(table_text):
+def extract_rows(table_text, start=0, end=None):
     """
     extract rows which are separated by pattern like '├─┼──┴──┴──┤' but '├──┤ ├──┤' or '│ ├──┤ │'.
+    table_text可以是全文，用start,end指定表格位置(see locate_tables)，不用先切出表格。
     :return: iterable of unstructure row of table .
     """
+    if end is None:
+        end = len(table_text)
 
-    pattern = r'''
-    \n├       #左邊界，需要\n知道換行，因為這裡不是一行一行找的
-    [┼┴┬─]+   #中間都是框架符號，不能有字
-    ┤\s*?\n    #右邊界
-    '''
-    start = re.search(r'┐', table_text).start()
-    end = re.search(r'└', table_text).end()
-    dividing_lines = re.finditer(pattern, table_text, re.VERBOSE)
-    line_starts = (m.start() + 1 for m in dividing_lines)
-    dividing_lines_pos = itertools.chain([start], line_starts, [end])  # +1 cuz a \n before ├
+    top = table_text.find('┐', start, end)
+    bottom = table_text.rfind('└', start, end)  # cell內的表格也有'└'，用最後一行的
+    if top == -1 or bottom == -1:
+        raise TableFormatException('table boundary not found :{}...'.format(table_text[start:start + 15]))
+
+    dividing_lines = dividing_line_regex.finditer(table_text, start, end)
+    line_starts = (m.start() + 1 for m in dividing_lines)  # +1 cuz a \n before ├
+    dividing_lines_pos = itertools.chain([top], line_starts, [bottom + 1])
 
-    pairs = slide2(dividing_lines_pos)
-    rows = (table_text[s:e] for s, e in pairs)
-    for row in rows:
-        start = row.find('│')
-        end = row.rfind('│') + 1
-        yield row[start:end]
+    for s, e in slide2(dividing_lines_pos):
+        row_start = table_text.find('│', s, e)
+        row_end = table_text.rfind('│', s, e) + 1
+        yield table_text[row_start:row_end]
 
 
 class TableFormatException(ValueError):
@@ -169,63 +678,137 @@ class TableFormatException(ValueError):
     pass
 
 
-def parse(rows):
+def display_width(s):
+    """寬度以半形字為1；中文字、全形字和框線字(east asian ambiguous)為2。"""
+    return sum(2 if unicodedata.east_asian_width(c) in 'WFA' else 1 for c in s)
+
+
+def _line_segments(line):
+    """
+    :return: tuple(list of (piece, start column, end column), list of separator start columns).
+        columns are display width from the start of line.
+    """
+    pieces = []
+    separators = []
+    last = 0
+    column = 0
+    for m in separator_regex.finditer(line):
+        piece = line[last:m.start()]
+        piece_end = column + display_width(piece)
+        if piece:
+            pieces.append((piece, column, piece_end))
+        separators.append(piece_end)
+        last = m.end()
+        column = piece_end + 2
+    if last < len(line):
+        pieces.append((line[last:], column, column + display_width(line[last:])))
+    return pieces, separators
+
+
+def parse_row(multiline_row):
     """
     structure the string of multiline row to one line for readability.
-    parse to readable cells of rows: ['cell1','cell2',cells,...],[...],rows...
-    columns數每一行要求一樣。
-
-    無法handle這種case：
+    每一行的columns數一樣時，直接把每行的第i個cell串起來。
+    columns數不一樣時(合併的儲存格，如下面的交易內容)，依框線字的位置(display width)對齊：
+    以框線最少的那一行當作columns，其他行的字放到開始位置所在的column，cell內的橫線不要。
 │號碼 │交易內容    │總價   │
 │    ├────┬──┬────┤      │
 │    │品名│單價│數量│      │
-    可以作但是比較麻煩。
+    -> ['號碼         ', '交易內容    品名單價數量', '總價               ']
+
+    :return: list of cell str.
+    """
+    lines = multiline_row.strip().split('\n')
+
+    column_lens = [len(separator_regex.findall(line)) for line in lines]
+    if all(l == column_lens[0] for l in column_lens):
+        pieces_per_line = [[e for e in separator_regex.split(line.strip()) if e != ''] for line in lines]
+        column_len = min([column_lens[0]] + [len(pieces) for pieces in pieces_per_line])
+        return [''.join(pieces[i] for pieces in pieces_per_line) for i in range(column_len)]
+
+    segments = [_line_segments(line.strip()) for line in lines]
+    candidates = [separators for _, separators in segments if len(separators) >= 2]
+    if not candidates:
+        raise TableFormatException('parsing fail, no column found :{}...'.format(multiline_row[:15]))
+    column_separators = min(candidates, key=len)
+
+    columns = [[] for _ in range(len(column_separators) - 1)]
+    for pieces, _ in segments:
+        for piece, start, end in pieces:
+            if rule_regex.fullmatch(piece):
+                continue
+            i = bisect.bisect_right(column_separators, start) - 1
+            columns[min(max(i, 0), len(columns) - 1)].append(piece)
+    return [''.join(column) for column in columns]
+
+
+def parse(rows):
+    """
+    structure the string of multiline row to one line for readability.
+    parse to readable cells of rows: ['cell1','cell2',cells,...],[...],rows...
+    see parse_row.
 
     :return: iterable of str list; the str list is a row and the str is a cell.
     """
-    pattern = r'[│├┤┼]'
-    for multiline_row in rows:
-        lines = multiline_row.strip().split('\n')
+    return (parse_row(multiline_row) for multiline_row in rows)
 
-        # requirement checking
-        # columns數每一行要求一樣
-        column_lens = (len(re.findall(pattern, line)) for line in lines)
-        column_len = next(column_lens)
-        if not all(l == column_len for l in column_lens):
-            raise TableFormatException('parsing fail, column is not consistent :{}...'.format(multiline_row[:15]))
 
-        result = [''] * column_len
-        for line in lines:
-            columns = (e for e in re.split(pattern, line.strip()) if e != '')
-            result = map(''.join, zip(result, columns))
+class Grid(collections.namedtuple('Grid', ['cells', 'row_starts'])):
+    """compact table: all cells in row order; row i is cells[row_starts[i]:row_starts[i + 1]]."""
+    __slots__ = ()
 
-        yield list(result)
+    def rows(self):
+        ends = self.row_starts[1:] + [len(self.cells)]
+        return [self.cells[s:e] for s, e in zip(self.row_starts, ends)]
 
 
-def extract_cells_per_table(text):
+def parse_table(text, start=0, end=None):
+    """parse table text[start:end] (see locate_tables).
+    :rtype : Grid
+    """
+    cells = []
+    row_starts = []
+    for multiline_row in extract_rows(text, start, end):
+        row_starts.append(len(cells))
+        cells += parse_row(multiline_row)
+    return Grid(cells, row_starts)
+
+
+def locate_tables_in_sections(text, sections=None, headings=None):
+    """只找指定sections內的表格，sections為None時找全文。see section_spans."""
+    if sections is None:
+        return locate_tables(text)
+    return [table for start, end in section_ranges(text, sections, headings)
+            for table in locate_tables(text, start, end)]
+
+
+def extract_cells_per_table(text, sections=None, headings=None):
     """抓出所有table，並parse into readable cells of table。
     輸出cells list per table,
     無法解析的table輸出[]. (fail at parsing)
+    :param sections: 只抓這些section內的table (names see SECTIONS)，None為全文。
+    :param headings: locate_sections(text)的結果，已經算過可以直接給。
     :return: Iterable of table which is composed of a list of cell strings ,
     :rtype : Iterable[list[str]]
     """
-    for table in extract_all_tables(text):
-        try:
-            readable_rows = parse(extract_rows(table))
-            cells = [cell_str for row in readable_rows for cell_str in row]
-            yield cells
-        except Exception as e:  #mainly TableFormatException
-            log.debug('{}'.format(e))
-            yield []
-            continue
+    for start, end in locate_tables_in_sections(text, sections, headings):
+        yield memo.table_cells(text, start, end, _parse_cells)
+
+
+def _parse_cells(text, start, end):
+    try:
+        return parse_table(text, start, end).cells
+    except Exception as e:  #mainly TableFormatException
+        log.debug('{}'.format(e))
+        return []
 
 
-def extract_cells(text):
+def extract_cells(text, sections=None):
     """抓出所有table，並parse into readable cell strings。
     無法解析的table自動跳過.
     :rtype : list[str]
     """
-    return list(itertools.chain.from_iterable(extract_cells_per_table(text)))
+    return list(itertools.chain.from_iterable(extract_cells_per_table(text, sections)))
 
 
 #
@@ -0,0 +1,147 @@
+"""
+Watch a directory and extract only the documents added or changed since the last poll.
+
+    python3 extract_declared_sentence.py <dir> --watch --format ndjson --output result.ndjson
+
+每次poll用os.scandir列出檔案，和index(sqlite，記錄 name, size, mtime, 內容hash)比對：
+size和mtime沒變的跳過；變了但內容hash相同的只更新index；新的或內容改變的才抽取，結果append到output。
+壓縮檔整個檔案為一個單位，改變時重新抽取全部member。mtime在settle秒內的檔案可能還在寫入，下次poll再處理。
+
+index也是checkpoint：每份doc的結果寫出後才記入index，中斷後重新啟動從沒記錄的檔案繼續。
+"""
+import collections
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+
+import sources
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PATH = 'watch_index.sqlite'
+File = collections.namedtuple('File', 'name path size mtime_ns digest')
+
+
+def content_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class Index(object):
+    """processed files of each watched root: name -> (size, mtime_ns, content hash)."""
+
+    def __init__(self, path=DEFAULT_PATH, root='.'):
+        self.root = os.path.abspath(root)
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (root TEXT NOT NULL, name TEXT NOT NULL, '
+                        'size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, digest TEXT NOT NULL, '
+                        'PRIMARY KEY (root, name))')
+
+    def load(self):
+        """:return: dict of name -> (size, mtime_ns, digest)"""
+        rows = self.db.execute('SELECT name, size, mtime_ns, digest FROM files WHERE root = ?', (self.root,))
+        return {name: (size, mtime_ns, digest) for name, size, mtime_ns, digest in rows}
+
+    def put(self, file):
+        self.db.execute('INSERT OR REPLACE INTO files (root, name, size, mtime_ns, digest) VALUES (?, ?, ?, ?, ?)',
+                        (self.root, file.name, file.size, file.mtime_ns, file.digest))
+
+    def close(self):
+        self.db.close()
+
+
+def poll(path, known, include=None, exclude=None, recursive=True, settle=1.0, now=None):
+    """
+    :param known: Index.load()
+    :return: list of File whose size or mtime differ from known (digest is the known one or None),
+        不含mtime在settle秒內的檔案。include, exclude see sources.iter_bytes，壓縮檔的member讀時才篩選。
+    """
+    now = time.time() if now is None else now
+    changed = []
+    for name, entry in sources.scan_tree(path, recursive):
+        if not sources.is_archive(name) and not sources.selected(name, include, exclude):
+            continue
+        stat = entry.stat()
+        old = known.get(name)
+        if old is not None and old[:2] == (stat.st_size, stat.st_mtime_ns):
+            continue
+        if now - stat.st_mtime < settle:
+            continue
+        changed.append(File(name, entry.path, stat.st_size, stat.st_mtime_ns, old[2] if old else None))
+    return changed
+
+
+def read_changes(files, marks, include=None, exclude=None, stats=None):
+    """
+    :return: iterable of (name, text) of the files whose content changed.
+    marks: deque, 依序append ('doc', name) 和 ('file', File with the new digest)，
+        ('file', ...) 在它最後一份doc之前(單一檔案)或之後(壓縮檔)，see _checkpoint。
+    """
+    for file in files:
+        start = time.perf_counter()
+        with open(file.path, 'rb') as f:
+            data = f.read()
+        digest = content_hash(data)
+        if digest == file.digest:
+            marks.append(('file', file))
+            continue
+        file = file._replace(digest=digest)
+        if not sources.is_archive(file.name):
+            text, encoding = sources.decode(data)
+            if stats is not None:
+                stats.record(file.name, len(data), encoding, time.perf_counter() - start)
+            marks.append(('file', file))
+            marks.append(('doc', file.name))
+            yield file.name, text
+            continue
+        del data
+        members = sources.iter_archive(file.path, file.name + '/', lambda member: not sources.hidden(member) and
+                                       sources.selected(member, include, exclude))
+        for name, text in sources.iter_decoded(members, stats):
+            marks.append(('doc', name))
+            yield name, text
+        marks.append(('file', file))
+
+
+def _checkpoint(index, known, marks, until=None):
+    """record the files in marks up to document until (all if None) in the index."""
+    while marks:
+        kind, item = marks.popleft()
+        if kind == 'file':
+            index.put(item)
+            known[item.name] = (item.size, item.mtime_ns, item.digest)
+        elif item == until:
+            return
+
+
+def run(path, extract, index_path=DEFAULT_PATH, interval=2.0, settle=1.0, polls=None,
+        include=None, exclude=None, recursive=True):
+    """
+    每interval秒poll一次path，抽取新增或改變的檔案，polls None為一直跑。
+    :param extract: function(documents, stats) -> iterable of results, 依documents的順序，
+        e.g. extract_declared_sentence.main(documents=documents, stats=stats, ...)
+    :return: iterable of results of extract. 一個結果被取用(寫出)後它的檔案才記入index。
+    """
+    index = Index(index_path, path)
+    try:
+        known = index.load()
+        n = 0
+        while polls is None or n < polls:
+            if n:
+                time.sleep(interval)
+            n += 1
+            files = poll(path, known, include, exclude, recursive, settle)
+            if not files:
+                continue
+            log.info('%d files added or changed', len(files))
+            marks = collections.deque()
+            stats = sources.ReadStats()
+            for result in extract(read_changes(files, marks, include, exclude, stats), stats):
+                yield result
+                _checkpoint(index, known, marks, result[0])
+            _checkpoint(index, known, marks)
+    finally:
+        index.close()